@@ -0,0 +1,178 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import lg_emulator
+import lg_monitor.patches
+import mstar_spi_dump as msd
+from lg_monitor import LgUsbMonitorControl, run_patches, startup
+from lg_monitor.control import BIG_U32_ADDR, MONITOR_INFO_STRUCT, VCP_D7_SET_1
+
+#
+# Benchmarks for the control-path hot spots, run against lg_emulator with a
+# fixed latency model so numbers are comparable between runs and machines.
+#
+#   python bench.py --out bench_results.json
+#   python bench.py --compare bench_results.json
+#
+
+# Every bridge read report costs this much, VCP replies take this long to be
+# ready. Roughly what the 28MQ780 does over USB.
+BENCH_LATENCY = 0.002
+BENCH_REPLY_DELAY = 0.005
+BENCH_SEED = 1234
+
+# Flag anything whose median got this much slower than the run we compare
+# against, small ops jitter a bit while the reply poller settles
+REGRESSION_RATIO = 1.25
+
+def new_monitor():
+    return lg_emulator.FakeMonitor(latency=BENCH_LATENCY, reply_delay=BENCH_REPLY_DELAY, seed=BENCH_SEED)
+
+def new_device(mon, patched=True):
+    device = LgUsbMonitorControl(backend=lg_emulator.fake_backend(mon))
+    device.init_usb()
+    if patched:
+        with quiet():
+            run_patches(device)
+    return device
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples)-1, int(round(p * (len(samples)-1))))]
+
+# setup(mon) runs once and returns whatever op(ctx) wants
+def run_bench(name, iterations, setup, op):
+    mon = new_monitor()
+    with quiet():
+        ctx = setup(mon)
+
+    samples = []
+    transactions = mon.transactions
+    start = time.perf_counter()
+    for i in range(0, iterations):
+        t = time.perf_counter()
+        with quiet():
+            op(ctx)
+        samples += [time.perf_counter() - t]
+    total = time.perf_counter() - start
+    transactions = mon.transactions - transactions
+
+    result = {
+        "iterations": iterations,
+        "ops_per_sec": iterations / total,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "transactions_per_op": transactions / iterations,
+    }
+    print ("%-28s %9.1f ops/s  p50 %9.2f ms  p99 %9.2f ms  %7.1f xfers/op" % (name, result["ops_per_sec"], result["p50_ms"], result["p99_ms"], result["transactions_per_op"]))
+    return result
+
+#
+# The benchmarks
+#
+def setup_patched(mon):
+    return new_device(mon)
+
+def setup_cold(mon):
+    # Fresh monitor every time, like right after it powers up
+    return mon
+
+def op_cold_run_patches(mon):
+    mon.reset()
+    run_patches(new_device(mon, patched=False))
+
+# Leaves a session behind for the warm start
+def setup_started(mon):
+    op_startup(mon)
+    return mon
+
+def op_startup(mon):
+    startup(LgUsbMonitorControl(backend=lg_emulator.fake_backend(mon)))
+
+def op_cold_startup(mon):
+    mon.reset()
+    op_startup(mon)
+
+def setup_flash(mon):
+    msd.device = msd.LgUsbMonitorControl(backend=lg_emulator.fake_backend(mon))
+    msd.device.init_usb()
+    return os.devnull
+
+def bench_all(scale):
+    def n(x):
+        return max(1, int(x * scale))
+
+    results = dict()
+    def add(name, iterations, setup, op):
+        results[name] = run_bench(name, iterations, setup, op)
+
+    add("get_vcp", n(100), setup_patched, lambda d: d.get_vcp(0x10))
+    add("set_vcp", n(100), setup_patched, lambda d: d.set_vcp(0x10, 50))
+    # Somewhere the shadow cache doesn't cover
+    add("lg_arbread_u8", n(100), setup_patched, lambda d: d.lg_arbread_u8(BIG_U32_ADDR))
+    for size in [0x4, 0x20, 0x100, 0x1000]:
+        iterations = n(max(2, 0x2000 // (size * 4)))
+        add("lg_arbread_data_%#x" % size, iterations, setup_patched, lambda d, size=size: d.lg_arbread_data(VCP_D7_SET_1, size, use_cache=False))
+    add("my_arbwrite_u32_be", n(100), setup_patched, lambda d: d.my_arbwrite_u32_be(MONITOR_INFO_STRUCT+0x800, 0x12345678))
+    add("run_patches_warm", n(20), setup_patched, run_patches)
+    add("run_patches_cold", n(3), setup_cold, op_cold_run_patches)
+    add("startup_warm", n(5), setup_started, op_startup)
+    add("startup_cold", n(2), setup_cold, op_cold_startup)
+    add("SPI_Flash_Dump_0x4000", n(5), setup_flash, lambda fpath: msd.SPI_Flash_Dump(fpath, 0x4000))
+    return results
+
+def compare(results, old_path):
+    with open(old_path) as f:
+        old = json.load(f)["results"]
+
+    regressed = False
+    print ("")
+    print ("vs", old_path)
+    for name in results:
+        if name not in old:
+            continue
+        ratio = results[name]["p50_ms"] / old[name]["p50_ms"]
+        flag = ""
+        if ratio > REGRESSION_RATIO:
+            flag = "  <-- slower"
+            regressed = True
+        print ("%-28s %6.2fx p50%s" % (name, ratio, flag))
+    return regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the monitor control path against the emulator")
+    parser.add_argument("--out", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare against a previous results file")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply iteration counts")
+    args = parser.parse_args()
+
+    # Keep the plan cache and warm start session away from the real ones
+    cache_dir = tempfile.mkdtemp(prefix="lg_bench_")
+    lg_monitor.patches.PATCH_PLAN_CACHE_DIR = cache_dir
+    lg_monitor.patches.SESSION_PATH = os.path.join(cache_dir, "session.json")
+
+    results = bench_all(args.scale)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                "latency_model": {"latency": BENCH_LATENCY, "reply_delay": BENCH_REPLY_DELAY, "seed": BENCH_SEED},
+                "python": platform.python_version(),
+                "timestamp": time.time(),
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare and compare(results, args.compare):
+        sys.exit(1)
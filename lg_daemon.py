@@ -0,0 +1,442 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+
+#
+# Headless mode: one long-lived process owns the monitors (opened, firmware
+# checked and patched once, heartbeat running) and everything else asks it
+# over a Unix socket, so a hotkey doesn't pay for startup every time.
+#
+#   python lg_daemon.py serve
+#   python lg_daemon.py scene splatoon
+#   python lg_daemon.py split top_bottom
+#   python lg_daemon.py inputs --primary usb-c
+#   python lg_daemon.py read 0x1000 0x20
+#
+# The protocol is JSON-RPC 2.0, one request or response per line:
+#
+#   {"jsonrpc": "2.0", "id": 1, "method": "set_split", "params": {"split": "top_bottom"}}
+#   {"jsonrpc": "2.0", "id": 1, "result": {"monitor": true}}
+#
+# Results are keyed by monitor, every call goes to all of them unless
+# "monitor" (a name from the "monitors" call, or an index) picks one.
+#
+# The client side doesn't import lg_monitor, it only needs the socket.
+#
+DAEMON_SOCKET_PATH = os.path.expanduser("~/.cache/lg_display_manager/daemon.sock")
+
+# Scene changes wait behind patching at worst
+DAEMON_CLIENT_TIMEOUT = 30.0
+
+# Biggest read or write one call can ask for
+DAEMON_MAX_MEMORY = 0x10000
+
+RPC_PARSE_ERROR = -32700
+RPC_INVALID_REQUEST = -32600
+RPC_METHOD_NOT_FOUND = -32601
+RPC_INVALID_PARAMS = -32602
+RPC_DEVICE_ERROR = -32000
+
+class RpcError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+#
+# Server side
+#
+# Filled in by serve(), the client doesn't need any of it
+lgm = None
+sessions = []
+hooks = None
+
+def param_int(params, name, default=None):
+    val = params.get(name, default)
+    if isinstance(val, bool) or not isinstance(val, int):
+        raise RpcError(RPC_INVALID_PARAMS, name + " should be an integer")
+    return val
+
+# Split names are the LG_SPLIT_* constants, lowercase and without the prefix
+def parse_split(val):
+    if isinstance(val, str):
+        name = "LG_SPLIT_" + val.upper()
+        if not hasattr(lgm.control, name):
+            raise RpcError(RPC_INVALID_PARAMS, "unknown split " + val)
+        return getattr(lgm.control, name)
+    if isinstance(val, bool) or not isinstance(val, int) or val < 0 or val > lgm.control.LG_SPLIT_FIX_AUDIO:
+        raise RpcError(RPC_INVALID_PARAMS, "split should be a name or 0-%d" % lgm.control.LG_SPLIT_FIX_AUDIO)
+    return val
+
+def parse_input(val):
+    if val is None:
+        return None
+    if isinstance(val, str):
+        names = [name.lower() for name in lgm.scenes.MONITOR_INPUT_NAMES]
+        if val.lower() not in names:
+            raise RpcError(RPC_INVALID_PARAMS, "unknown input " + val)
+        return names.index(val.lower())
+    if isinstance(val, bool) or not isinstance(val, int) or val < 0 or val >= len(lgm.scenes.MONITOR_INPUT_NAMES):
+        raise RpcError(RPC_INVALID_PARAMS, "input should be a name or 0-%d" % (len(lgm.scenes.MONITOR_INPUT_NAMES)-1))
+    return val
+
+def pick_sessions(params):
+    which = params.get("monitor")
+    if which is None:
+        return sessions
+    for i, session in enumerate(sessions):
+        if which == i or which == session.name():
+            return [session]
+    raise RpcError(RPC_INVALID_PARAMS, "no monitor " + str(which))
+
+# Runs fn(control, ...) on the picked monitors' workers, returns
+# {monitor: result}. A command that got superseded by a later one for the
+# same thing before it ran comes back as "superseded".
+def on_monitors(params, priority, targets, fn, *args):
+    picked = pick_sessions(params)
+    futures = lgm.schedule_all(picked, priority, targets, fn, *args)
+
+    results = dict()
+    errors = []
+    for session, future in zip(picked, futures):
+        try:
+            results[session.name()] = future.result()
+        except concurrent.futures.CancelledError:
+            results[session.name()] = "superseded"
+        except Exception as e:
+            errors += ["%s: %s" % (session.name(), e)]
+    if errors:
+        raise RpcError(RPC_DEVICE_ERROR, ", ".join(errors))
+    return results
+
+def set_inputs(control, primary):
+    control.lg_set_primary_input(primary)
+    return lgm.scene_state(control, with_split=False, use_cache=False)
+
+def read_memory(control, addr, data_len, use_cache):
+    return bytes(control.lg_arbread_data(addr, data_len, use_cache)).hex()
+
+def write_memory(control, addr, data, atomic):
+    if atomic:
+        control.my_arbwrite(addr, data)
+    else:
+        control.lg_arbwrite(addr, data)
+    return True
+
+def rpc_monitors(params):
+    return [{"name": s.name(), "link_state": s.control.link_state, "firmware": s.control.firmware} for s in sessions]
+
+def rpc_scene(params):
+    scene = params.get("scene")
+    if scene not in lgm.SCENES:
+        raise RpcError(RPC_INVALID_PARAMS, "scene should be one of " + ", ".join(sorted(lgm.SCENES)))
+    return on_monitors(params, lgm.PRIORITY_USER, lgm.scenes.scene_targets(scene), lgm.apply_scene, scene)
+
+def rpc_set_split(params):
+    split = parse_split(params.get("split"))
+    return on_monitors(params, lgm.PRIORITY_USER, [("vcp", 0xd7)], lgm.LgUsbMonitorControl.lg_set_split, split)
+
+#
+# Only the primary input has a command the monitor acts on (0xF4). The
+# secondary is just a byte in RAM that the monitor picks up on a split
+# change, so writing it alone leaves the picture as it was; that goes
+# through a scene instead.
+#
+def rpc_set_inputs(params):
+    if params.get("secondary") is not None:
+        raise RpcError(RPC_INVALID_PARAMS, "the secondary input can't be set on its own, use a scene or swap_splits")
+    primary = parse_input(params.get("primary"))
+    if primary is None:
+        raise RpcError(RPC_INVALID_PARAMS, "primary is required")
+    return on_monitors(params, lgm.PRIORITY_USER, [("mem", lgm.control.MONITOR_INFO_STRUCT+0x2d0)], set_inputs, primary)
+
+# Toggles, never coalesced
+def rpc_swap_sound(params):
+    return on_monitors(params, lgm.PRIORITY_USER, None, lgm.scenes.do_swap_sound_sources)
+
+def rpc_swap_splits(params):
+    return on_monitors(params, lgm.PRIORITY_USER, None, lgm.scenes.do_swap_splits)
+
+def rpc_state(params):
+    return on_monitors(params, lgm.PRIORITY_NORMAL, None, lgm.scene_state, True, not params.get("uncached", False))
+
+def rpc_read(params):
+    addr = param_int(params, "addr")
+    data_len = param_int(params, "len")
+    if data_len <= 0 or data_len > DAEMON_MAX_MEMORY:
+        raise RpcError(RPC_INVALID_PARAMS, "len should be 1-%#x" % DAEMON_MAX_MEMORY)
+    return on_monitors(params, lgm.PRIORITY_NORMAL, None, read_memory, addr, data_len, bool(params.get("cached", False)))
+
+def rpc_write(params):
+    addr = param_int(params, "addr")
+    try:
+        data = list(bytes.fromhex(params.get("data", "")))
+    except (TypeError, ValueError):
+        raise RpcError(RPC_INVALID_PARAMS, "data should be a hex string")
+    if not data or len(data) > DAEMON_MAX_MEMORY:
+        raise RpcError(RPC_INVALID_PARAMS, "data should be 1-%#x bytes" % DAEMON_MAX_MEMORY)
+    return on_monitors(params, lgm.PRIORITY_NORMAL, None, write_memory, addr, data, bool(params.get("atomic", True)))
+
+# Stats are locked on their own, these don't go through the workers. The
+# snapshot is what do_dump_stats saves, "text" gets the tray's table instead.
+def rpc_stats(params):
+    results = dict()
+    for session in pick_sessions(params):
+        if params.get("text"):
+            results[session.name()] = session.control.stats.report()
+        else:
+            results[session.name()] = session.control.stats.snapshot()
+        if params.get("reset"):
+            session.control.stats.reset()
+    return results
+
+RPC_METHODS = {
+    "monitors": rpc_monitors,
+    "scene": rpc_scene,
+    "set_split": rpc_set_split,
+    "set_inputs": rpc_set_inputs,
+    "swap_sound": rpc_swap_sound,
+    "swap_splits": rpc_swap_splits,
+    "state": rpc_state,
+    "read": rpc_read,
+    "write": rpc_write,
+    "stats": rpc_stats,
+}
+
+# Returns the response, or None for a notification
+def handle_request(line):
+    try:
+        req = json.loads(line)
+    except ValueError as e:
+        return {"jsonrpc": "2.0", "id": None, "error": {"code": RPC_PARSE_ERROR, "message": str(e)}}
+
+    req_id = req.get("id") if isinstance(req, dict) else None
+    try:
+        if not isinstance(req, dict) or not isinstance(req.get("method"), str):
+            raise RpcError(RPC_INVALID_REQUEST, "expected an object with a method")
+        method = RPC_METHODS.get(req["method"])
+        if method is None:
+            raise RpcError(RPC_METHOD_NOT_FOUND, "no method " + req["method"])
+        params = req.get("params", dict())
+        if not isinstance(params, dict):
+            raise RpcError(RPC_INVALID_PARAMS, "params should be an object")
+        resp = {"jsonrpc": "2.0", "id": req_id, "result": method(params)}
+    except RpcError as e:
+        resp = {"jsonrpc": "2.0", "id": req_id, "error": {"code": e.code, "message": str(e)}}
+    except Exception as e:
+        resp = {"jsonrpc": "2.0", "id": req_id, "error": {"code": RPC_DEVICE_ERROR, "message": "%s: %s" % (type(e).__name__, e)}}
+
+    if isinstance(req, dict) and "id" not in req:
+        return None
+    return resp
+
+# One per connection, a client can keep it open for as many calls as it likes
+class RpcHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            resp = handle_request(line)
+            if resp is not None:
+                self.wfile.write(json.dumps(resp).encode("utf-8") + b"\n")
+
+class RpcServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+# Gets rid of a socket left behind by a daemon that died, refuses to start
+# next to one that's still answering
+def claim_socket_path(path):
+    if not os.path.exists(path):
+        return True
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return False
+    except OSError:
+        os.unlink(path)
+        return True
+    finally:
+        sock.close()
+
+def heartbeat_loop(stop):
+    while not stop.wait(lgm.HEARTBEAT_INTERVAL):
+        lgm.heartbeat_all(sessions, hooks)
+
+def serve(path, emulate=0):
+    global lgm, sessions, hooks
+    import lg_monitor
+    lgm = lg_monitor
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not claim_socket_path(path):
+        print ("Another daemon is already listening on", path)
+        return 1
+
+    enumerate_fn = backend = None
+    if emulate:
+        import lg_emulator
+        # Keep the fake monitors' warm start sessions away from the real ones
+        cache_dir = tempfile.mkdtemp(prefix="lg_daemon_")
+        lgm.patches.PATCH_PLAN_CACHE_DIR = cache_dir
+        lgm.patches.SESSION_PATH = os.path.join(cache_dir, "session.json")
+        enumerate_fn, backend = lg_emulator.fake_bus([lg_emulator.FakeMonitor() for i in range(0, emulate)])
+    else:
+        # The hooks poke the real desktop, fake monitors shouldn't set them off
+        hooks = lgm.HookRunner(lgm.HEARTBEAT_HOOKS)
+    sessions = lgm.start_monitor_sessions(enumerate_fn, backend, hooks)
+    if not sessions:
+        return 1
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=heartbeat_loop, args=(stop,), name="lg_heartbeat", daemon=True)
+    heartbeat.start()
+
+    # Only we get to poke at the monitor's RAM
+    old_umask = os.umask(0o077)
+    try:
+        server = RpcServer(path, RpcHandler)
+    finally:
+        os.umask(old_umask)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print ("Listening on", path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        stop.set()
+        for session in sessions:
+            session.stop()
+    return 0
+
+#
+# Client side
+#
+def call(method, params=None, path=DAEMON_SOCKET_PATH, timeout=DAEMON_CLIENT_TIMEOUT):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({"jsonrpc": "2.0", "id": 1, "method": method, "params": params or dict()}).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    finally:
+        sock.close()
+
+    if not line:
+        raise RpcError(RPC_DEVICE_ERROR, "daemon hung up")
+    resp = json.loads(line)
+    if "error" in resp:
+        raise RpcError(resp["error"]["code"], resp["error"]["message"])
+    return resp["result"]
+
+# Numbers go over as numbers, names as strings
+def int_or_name(s):
+    try:
+        return int(s, 0)
+    except ValueError:
+        return s
+
+def print_result(result):
+    if isinstance(result, dict) and len(result) == 1:
+        result = next(iter(result.values()))
+    elif isinstance(result, dict):
+        for name in result:
+            val = result[name] if isinstance(result[name], str) else json.dumps(result[name])
+            print (name + ":" + ("\n" if "\n" in val else " ") + val)
+        return
+    print (result if isinstance(result, str) else json.dumps(result, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive LG monitors through a long-lived daemon")
+    parser.add_argument("--socket", default=DAEMON_SOCKET_PATH, help="daemon socket (default: %(default)s)")
+    parser.add_argument("--monitor", type=int_or_name, help="only this monitor, by name or index")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("serve", help="open the monitors and answer requests until killed")
+    p.add_argument("--emulate", type=int, default=0, metavar="N", help="serve N lg_emulator monitors instead")
+
+    sub.add_parser("monitors", help="list the monitors the daemon has")
+
+    p = sub.add_parser("scene", help="apply a scene, like the tray menu")
+    p.add_argument("scene")
+
+    p = sub.add_parser("split", help="set the split, by LG_SPLIT_* name (top_bottom) or number")
+    p.add_argument("split", type=int_or_name)
+
+    p = sub.add_parser("inputs", help="set the primary input")
+    p.add_argument("--primary", type=int_or_name, required=True, help="HDMI1, HDMI2, DP, USB-C or a number")
+
+    sub.add_parser("swap-sound", help="swap which side the sound comes from")
+    sub.add_parser("swap-splits", help="swap the primary and secondary sides")
+
+    p = sub.add_parser("state", help="show the split, inputs and sound source")
+    p.add_argument("--uncached", action="store_true", help="ask the monitor instead of the shadow cache")
+
+    p = sub.add_parser("read", help="read monitor RAM, printed as hex")
+    p.add_argument("addr", type=lambda s: int(s, 0))
+    p.add_argument("len", type=lambda s: int(s, 0))
+    p.add_argument("--cached", action="store_true", help="allow answers from the shadow cache")
+
+    p = sub.add_parser("write", help="write hex bytes to monitor RAM")
+    p.add_argument("addr", type=lambda s: int(s, 0))
+    p.add_argument("data", help="hex, spaces allowed")
+    p.add_argument("--non-atomic", action="store_true", help="use the 0xCC arbwrite instead of the D5/D7 patch")
+
+    p = sub.add_parser("stats", help="transaction stats")
+    p.add_argument("--json", action="store_true", help="the full snapshot instead of a table")
+    p.add_argument("--reset", action="store_true", help="start counting again afterwards")
+
+    args = parser.parse_args()
+
+    if args.cmd == "serve":
+        sys.exit(serve(args.socket, args.emulate))
+
+    params = dict()
+    if args.monitor is not None:
+        params["monitor"] = args.monitor
+
+    if args.cmd == "monitors":
+        method = "monitors"
+    elif args.cmd == "scene":
+        method = "scene"
+        params["scene"] = args.scene
+    elif args.cmd == "split":
+        method = "set_split"
+        params["split"] = args.split
+    elif args.cmd == "inputs":
+        method = "set_inputs"
+        params.update(primary=args.primary)
+    elif args.cmd == "swap-sound":
+        method = "swap_sound"
+    elif args.cmd == "swap-splits":
+        method = "swap_splits"
+    elif args.cmd == "state":
+        method = "state"
+        params["uncached"] = args.uncached
+    elif args.cmd == "read":
+        method = "read"
+        params.update(addr=args.addr, len=args.len, cached=args.cached)
+    elif args.cmd == "write":
+        method = "write"
+        params.update(addr=args.addr, data=args.data, atomic=not args.non_atomic)
+    elif args.cmd == "stats":
+        method = "stats"
+        params.update(text=not args.json, reset=args.reset)
+
+    try:
+        print_result(call(method, params, args.socket))
+    except (OSError, RpcError) as e:
+        print ("lg_daemon:", e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,372 @@
+import random
+import struct
+import threading
+import time
+
+from lg_monitor.control import (
+    LG_MONITOR_CONTROL_VID, LG_MONITOR_CONTROL_PID, LG_MONITOR_DDCCI_I2C_ADDR,
+    LG_SPLIT_NONE, LG_SPLIT_FIX_AUDIO, LG_SOUND_MAIN,
+    LG_MONITOR_HDMI1, LG_MONITOR_HDMI2, LG_MONITOR_DP1, LG_MONITOR_USB_C,
+    MONITOR_HDMI1, MONITOR_HDMI2, MONITOR_DP1, MONITOR_USB_C,
+    VCP_D7_SET_1, DDC_50_D1_1, DDC_50_D1_BURST, DDC_50_D5_1, DDC_50_D5_BURST,
+    DDC_50_D1_CHECKSUM, DDC_50_DEFAULT_CASE, DDC_50_SWITCHTABLE, DDC_NULL_MESSAGE,
+    MONITOR_INFO_STRUCT, region_checksum_data,
+)
+
+#
+# In-process stand-in for a 28MQ780 (scalar v3.3.0) behind its HID I2C
+# bridge, so the control path can be exercised and benchmarked without the
+# monitor. Plug it in with:
+#
+#   mon = FakeMonitor(latency=0.002)
+#   device = LgUsbMonitorControl(backend=lambda: FakeHidDevice(mon))
+#
+
+LG_MONITOR_SERDB_I2C_ADDR = 0x59
+LG_MONITOR_FLASH_I2C_ADDR = 0x49
+
+MSTARDDC_SPI_WRITE = 0x10
+
+RAM_SIZE = 0x01000000
+
+# Where the firmware keeps code we patch, a reset reloads it
+CODE_START = 0x00290000
+CODE_END = 0x002f0000
+
+#
+# Code we know how to "run". This doesn't interpret AEON R2, it recognizes
+# the bytes our patches put down and behaves like them. Anything else a
+# switch-table case points at just acks.
+#
+CODE_ATOMIC_READ = bytes.fromhex(
+    "106a044c6340108a054463254c6340108a064463254c6340108a07446325"
+    "1063001872015060822ffb0e")
+CODE_ATOMIC_WRITE = bytes.fromhex(
+    "106a044c6340108a054463254c6340108a064463254c6340108a07446325"
+    "108a08188300506082935a")
+CODE_BURST_READ = bytes.fromhex(
+    "106a044c6340108a054463254c6340108a064463254c6340108a07446325"
+    "1cb201108a08d08000ca1c84ff188a081083001885001c63011ca5012fffe7"
+    "5060822ffacb")
+CODE_BURST_WRITE = bytes.fromhex(
+    "106a044c6340108a054463254c6340108a064463254c6340108a07446325"
+    "1caa09108a08d08000ca1c84ff188a081085001883001c63011ca5012fffe7"
+    "5060822fff16")
+CODE_REGION_CHECKSUM = bytes.fromhex(
+    "106a044c6340108a054463254c6340108a064463254c6340108a07446325"
+    "108a084c844010aa0944842d50a00050c000d08000b21c84ff10e30044a538"
+    "44c6281c63012fffed18b2044ca54118b2034ca54118b2024ca54118b201"
+    "18d2084cc64118d2074cc64118d2064cc64118d2055060822ffa55")
+
+# First word of the patched VCP 0xD7 setter
+VCP_D7_SET_PATCHED = bytes.fromhex("d140326a")
+
+# 0x50 cases that stock firmware points somewhere past the start of the D1
+# and D5 handlers, made up but in the same spots as the ones we know about
+STOCK_CAVE_CASES = [
+    (0x68, DDC_50_D1_1+0x1c),
+    (0x69, DDC_50_D5_1+0x18),
+    (0x6a, DDC_50_D1_1+0x9c),
+    (0x6c, DDC_50_D5_1+0x2a),
+    (0x6d, DDC_50_D5_1+0x4e),
+    (0x75, DDC_50_D1_1+0x80),
+    (0xd6, DDC_50_D1_1+0x50),
+    (0xd7, DDC_50_D5_1+0x30),
+]
+
+class FakeMonitor:
+
+    # latency: seconds added to every bridge read report
+    # reply_delay: seconds before a VCP or LG special reply is ready, earlier
+    #   reads get the DDC/CI null message
+    # drop_rate: fraction of bridge writes that silently go nowhere
+    def __init__(self, latency=0.0, reply_delay=0.0, drop_rate=0.0, seed=0, flash_size=0x10000):
+        self.latency = latency
+        self.reply_delay = reply_delay
+        self.drop_rate = drop_rate
+        # Set to pretend the cable got pulled, every HID call then throws
+        self.unplugged = False
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.ram = bytearray(RAM_SIZE)
+        self.flash = bytearray((i * 7 + (i >> 8)) & 0xFF for i in range(flash_size))
+        self.vcp = {0x10: 50, 0x12: 70, 0xd7: LG_SPLIT_NONE}
+        self.model = b"28MQ780"
+        self.scalar_version = bytes([0x82, 0x03, 0x30])
+
+        self.ram[MONITOR_INFO_STRUCT+0x2b5] = LG_SOUND_MAIN
+        self.ram[MONITOR_INFO_STRUCT+0x2d0] = LG_MONITOR_USB_C
+        self.ram[MONITOR_INFO_STRUCT+0x2d1] = LG_MONITOR_HDMI2
+
+        # Counters
+        self.transactions = 0
+        self.dropped = 0
+        self.resets = 0
+
+        self.reset()
+
+    def reset(self):
+        self.ram[CODE_START:CODE_END] = bytes(CODE_END - CODE_START)
+        for idx in range(0x10, 0x100):
+            self.set_switchtable_case(idx, DDC_50_DEFAULT_CASE)
+        self.set_switchtable_case(0xd1, DDC_50_D1_1)
+        self.set_switchtable_case(0xd5, DDC_50_D5_1)
+        # Stock handlers further along that our code lands on top of
+        for idx, addr in STOCK_CAVE_CASES:
+            self.set_switchtable_case(idx, addr)
+
+        self.arb_ptr = 0
+        self.spi_stream = b""
+        self.i2c_reply = dict()
+        self.reply_ready = 0.0
+
+    def set_switchtable_case(self, idx, val):
+        struct.pack_into("<L", self.ram, DDC_50_SWITCHTABLE+((idx-0x10)*4), val)
+
+    def get_switchtable_case(self, idx):
+        return struct.unpack_from("<L", self.ram, DDC_50_SWITCHTABLE+((idx-0x10)*4))[0]
+
+    def code_at(self, addr, code):
+        return bytes(self.ram[addr:addr+len(code)]) == code
+
+    #
+    # I2C slaves behind the bridge
+    #
+    def i2c_write(self, addr, data):
+        if addr == LG_MONITOR_DDCCI_I2C_ADDR:
+            self.ddc_write(data)
+        elif addr == LG_MONITOR_FLASH_I2C_ADDR:
+            self.flash_write(data)
+
+    def i2c_read(self, addr, to_read):
+        if addr == LG_MONITOR_FLASH_I2C_ADDR:
+            out = self.spi_stream[:to_read]
+            self.spi_stream = self.spi_stream[to_read:]
+        elif addr == LG_MONITOR_DDCCI_I2C_ADDR:
+            if time.monotonic() < self.reply_ready:
+                out = DDC_NULL_MESSAGE
+            else:
+                pending = self.i2c_reply.get(addr, b"")
+                out = pending[:to_read]
+                self.i2c_reply[addr] = pending[to_read:]
+        else:
+            out = b""
+        return out + bytes(to_read - len(out))
+
+    #
+    # SPI flash in ISP mode, only what mstar_spi_dump.py uses
+    #
+    def flash_write(self, data):
+        if len(data) < 2 or data[0] != MSTARDDC_SPI_WRITE:
+            return
+        cmd = data[1]
+        if cmd == 0x03:
+            addr = (data[2] << 16) | (data[3] << 8) | data[4]
+            self.spi_stream = bytes(self.flash[addr:addr+0x10000])
+        elif cmd == 0x05:
+            self.spi_stream = bytes([0x00]) # SR1, not busy
+        elif cmd == 0x9F:
+            self.spi_stream = bytes([0xef, 0x40, 0x18]) # W25Q128
+
+    #
+    # DDC/CI, 0x51 for VCP and 0xCC arbwrites, 0x50 for LG specials
+    #
+    def ddc_write(self, data):
+        if len(data) < 3:
+            return
+        which = data[0]
+        data_len = data[1] & 0x7F
+        chk = 0x6E
+        for b in data[:2+data_len+1]:
+            chk ^= b
+        if chk != 0:
+            return
+
+        msg = data[2:2+data_len]
+        if which == 0x51:
+            reply = self.vcp_command(msg)
+        elif which == 0x50:
+            reply = self.lg_special_command(msg)
+        else:
+            return
+        self.reply_ready = time.monotonic() + self.reply_delay
+
+        if reply is not None:
+            self.i2c_reply[LG_MONITOR_DDCCI_I2C_ADDR] = bytes(reply)
+
+    def vcp_reply(self, idx, cur, max_val=0xFFFF):
+        reply = [0x6E, 0x88, 0x02, 0x00, idx, 0x00, (max_val >> 8) & 0xFF, max_val & 0xFF, (cur >> 8) & 0xFF, cur & 0xFF]
+        chk = 0x6E ^ 0x50
+        for b in reply[1:]:
+            chk ^= b
+        return reply + [chk]
+
+    def vcp_command(self, msg):
+        op = msg[0]
+        if op == 0x01:
+            idx = msg[1]
+            return self.vcp_reply(idx, self.vcp.get(idx, 0))
+        elif op == 0x03:
+            idx = msg[1]
+            val = (msg[2] << 8) | msg[3]
+            if idx == 0xd7 and self.code_at(VCP_D7_SET_1, VCP_D7_SET_PATCHED) and val == LG_SPLIT_FIX_AUDIO:
+                # Patched 0xE applies the sound source, the split stays
+                pass
+            else:
+                self.vcp[idx] = val
+            return self.vcp_reply(idx, self.vcp.get(idx, 0))
+        elif op == 0xcc:
+            # LG arbwrite, no reply at all
+            if msg[1] == 0xf6:
+                self.arb_ptr = struct.unpack("<L", bytes(msg[2:6]))[0]
+            elif msg[1] == 0xf4:
+                payload = bytes(msg[2:])
+                self.ram[self.arb_ptr:self.arb_ptr+len(payload)] = payload
+                self.arb_ptr += len(payload)
+        return None
+
+    def lg_special_command(self, msg):
+        reply = bytearray(0x26)
+        idx = msg[1]
+        if idx == 0xc9:
+            reply[0:3] = self.scalar_version
+        elif idx == 0xca:
+            reply[0:len(self.model)] = self.model
+        elif idx == 0xf4:
+            ddc_lut = {MONITOR_HDMI1: LG_MONITOR_HDMI1, MONITOR_HDMI2: LG_MONITOR_HDMI2, MONITOR_DP1: LG_MONITOR_DP1, MONITOR_USB_C: LG_MONITOR_USB_C}
+            self.ram[MONITOR_INFO_STRUCT+0x2d0] = ddc_lut.get(msg[3], LG_MONITOR_HDMI1)
+            reply[0] = 0x82
+        elif idx == 0xf5:
+            self.resets += 1
+            self.reset()
+            reply[0] = 0x82
+        elif idx >= 0x10:
+            self.run_case(self.get_switchtable_case(idx), msg, reply)
+        return reply
+
+    def run_case(self, target, msg, reply):
+        addr = 0
+        if len(msg) >= 6:
+            addr = struct.unpack(">L", bytes(msg[2:6]))[0] % RAM_SIZE
+
+        if target == DDC_50_D1_1 and self.code_at(target, CODE_ATOMIC_READ):
+            reply[0] = 0x82
+            reply[1] = self.ram[addr]
+        elif target == DDC_50_D5_1 and self.code_at(target, CODE_ATOMIC_WRITE):
+            self.ram[addr] = msg[6]
+            reply[0] = 0x82
+        elif target == DDC_50_D1_BURST and self.code_at(target, CODE_BURST_READ):
+            count = msg[6]
+            reply[0] = 0x82
+            reply[1:1+count] = self.ram[addr:addr+count]
+        elif target == DDC_50_D5_BURST and self.code_at(target, CODE_BURST_WRITE):
+            count = msg[6]
+            self.ram[addr:addr+count] = bytes(msg[7:7+count])
+            reply[0] = 0x82
+        elif target == DDC_50_D1_CHECKSUM and self.code_at(target, CODE_REGION_CHECKSUM):
+            count = struct.unpack(">H", bytes(msg[6:8]))[0]
+            reply[0] = 0x82
+            struct.pack_into(">Q", reply, 1, region_checksum_data(self.ram[addr:addr+count]))
+        else:
+            # Whatever LG had there, it at least acks
+            reply[0] = 0x82
+
+#
+# hid.device() lookalike talking to a FakeMonitor
+#
+class FakeHidDevice:
+
+    # bus: {path: FakeMonitor} for open_path(), see fake_bus()
+    def __init__(self, monitor=None, bus=None):
+        if monitor is None and bus is None:
+            monitor = FakeMonitor()
+        self.monitor = monitor
+        self.bus = bus
+        self.reports = []
+        self.is_open = False
+        self.nonblocking = False
+
+    def open(self, vid=LG_MONITOR_CONTROL_VID, pid=LG_MONITOR_CONTROL_PID, serial=None):
+        if self.monitor.unplugged:
+            raise IOError("open failed")
+        self.is_open = True
+
+    def open_path(self, path):
+        if self.bus is not None:
+            self.monitor = self.bus[path]
+        if self.monitor.unplugged:
+            raise IOError("open failed")
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def set_nonblocking(self, v):
+        self.nonblocking = bool(v)
+
+    def write(self, pkt):
+        if not self.is_open or self.monitor.unplugged:
+            raise IOError("device not open")
+        pkt = bytes(pkt)
+        mon = self.monitor
+        with mon.lock:
+            mon.transactions += 1
+            if mon.drop_rate and mon.rng.random() < mon.drop_rate:
+                mon.dropped += 1
+                return len(pkt)
+
+            if pkt[1] == 0x01:
+                # [0x08, 0x01, 0x55, 0x03, len, 0x00, 0x03, addr, data...]
+                mon.i2c_write(pkt[7], pkt[8:8+pkt[4]])
+            elif pkt[1] == 0x02:
+                # [0x08, 0x02, 0x55, 0x04, to_read, 0x00, 0x0b, addr]
+                to_read = pkt[4]
+                self.reports += [bytes([to_read + 4, 0x02, 0x55, 0x00]) + mon.i2c_read(pkt[7], to_read)]
+        return len(pkt)
+
+    def read(self, amt, timeout=0):
+        if not self.is_open or self.monitor.unplugged:
+            raise IOError("device not open")
+        if not self.reports:
+            # Real hidapi would sit out the whole timeout
+            if timeout and not self.nonblocking:
+                time.sleep(timeout / 1000.0)
+            return []
+
+        if self.monitor.latency:
+            time.sleep(self.monitor.latency)
+        report = self.reports.pop(0)
+        report = report + bytes(max(0, 0x40 - len(report)))
+        return list(report[:amt])
+
+# For LgUsbMonitorControl(backend=...)
+def fake_backend(monitor):
+    return lambda: FakeHidDevice(monitor)
+
+# Several monitors at once: returns (enumerate_fn, backend) for
+# lg_monitor.open_monitor_sessions()
+# serials: False for monitors that don't report one
+# interfaces: HID interfaces each monitor lists, the first is the I2C bridge
+def fake_bus(monitors, serials=True, interfaces=1):
+    bus = dict()
+    infos = []
+    for i, monitor in enumerate(monitors):
+        for iface in range(0, interfaces):
+            path = b"fake:%d" % i
+            if iface:
+                path += b".%d" % iface
+            bus[path] = monitor
+            infos += [{
+                "path": path,
+                "serial_number": "FAKE%04d" % i if serials else "",
+                "vendor_id": LG_MONITOR_CONTROL_VID,
+                "product_id": LG_MONITOR_CONTROL_PID,
+                "interface_number": iface,
+                "usage_page": 0xff00 if iface == 0 else 0x000c,
+                "usage": 1,
+            }]
+
+    def enumerate_fn(vid=0, pid=0):
+        return [info for info in infos if info["vendor_id"] == vid and info["product_id"] == pid]
+    return enumerate_fn, lambda: FakeHidDevice(bus=bus)
@@ -0,0 +1,26 @@
+#
+# Everything it takes to drive an LG DualUp (28MQ780, scalar v3.3.0) from
+# Python, without the tray app:
+#
+#   control   one monitor: HID I2C bridge, DDC/CI, LG specials, the worker
+#   patches   the firmware patches, startup and warm starts
+#   sessions  several monitors, asyncio, watching memory
+#   heartbeat keeping the patches in
+#   scenes    layouts
+#   codec     report and DDC/CI packet building
+#   backend   hidapi, imported on first use
+#
+# Nothing here imports hid or rumps up front, and nothing keeps a global
+# device, so any number of LgUsbMonitorControls can live in one process.
+#
+from lg_monitor.control import (
+    DeviceDisconnected, DeviceTimeout, DeviceWorker, LgUsbMonitorControl,
+    PRIORITY_BACKGROUND, PRIORITY_NORMAL, PRIORITY_USER, enumerate_monitors,
+)
+from lg_monitor.heartbeat import HEARTBEAT_HOOKS, HEARTBEAT_INTERVAL, HookRunner, heartbeat, heartbeat_all
+from lg_monitor.patches import SUPPORTED_FIRMWARE, read_firmware, run_patches, startup, warm_start
+from lg_monitor.scenes import SCENES, apply_scene, scene_state
+from lg_monitor.sessions import (
+    AsyncLgUsbMonitorControl, MemoryWatcher, MonitorSession, fan_out,
+    open_monitor_sessions, schedule_all, start_monitor_sessions, submit_all,
+)
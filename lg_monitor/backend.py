@@ -0,0 +1,22 @@
+#
+# hidapi, imported the first time something actually opens or enumerates a
+# monitor. Anything running against lg_emulator, or that never touches the
+# USB side (the daemon client, snapshot diffs), doesn't need it installed.
+#
+hid = None
+
+def load_hid():
+    global hid
+    if hid is None:
+        try:
+            import hid as hid_module
+        except ImportError as e:
+            raise ImportError("talking to a real monitor needs hidapi (pip install hidapi), see lg_emulator.py otherwise") from e
+        hid = hid_module
+    return hid
+
+def hid_device():
+    return load_hid().device()
+
+def hid_enumerate(vid, pid):
+    return load_hid().enumerate(vid, pid)
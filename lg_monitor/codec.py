@@ -0,0 +1,91 @@
+import functools
+import operator
+import struct
+
+#
+# Packets for the HID I2C bridge and the DDC/CI messages riding on it.
+#
+# Outgoing reports get built in place in one reusable 64 byte buffer, and
+# read payloads get copied straight into a preallocated bytearray, so a
+# transaction doesn't glue together a handful of lists and bytes.
+#
+HID_REPORT_SIZE = 0x40
+
+# [0x08, 0x01, 0x55, 0x03, len, 0x00, 0x03, i2c addr] + data
+BRIDGE_WRITE = struct.Struct("BBBBBBBB")
+# [0x08, 0x02, 0x55, 0x04, to_read, 0x00, 0x0b, i2c addr]
+BRIDGE_READ = struct.Struct("BBBBBBBB")
+BRIDGE_WRITE_MAX = HID_REPORT_SIZE - BRIDGE_WRITE.size
+
+# Read reports are [payload len + 4, ?, ?, ?] + payload
+BRIDGE_REPLY_HEADER = 4
+
+# DDC/CI requests are [source addr, len] + payload + checksum, the checksum
+# also covers the destination (0x6E)
+DDC_HEADER = struct.Struct("BB")
+DDC_CHECKSUM_SEED = 0x6E
+
+# DDC/CI payloads: VCP sets and LG specials are [0x03, idx] + value (big
+# endian), the 0xCC arbwrite pointer is [0xcc, idx] + little endian address
+LG_SPECIAL_U16 = struct.Struct(">BBH")
+LG_SPECIAL_U32 = struct.Struct(">BBL")
+LG_SPECIAL_U32_U8 = struct.Struct(">BBLB")
+LG_CC_U32 = struct.Struct("<BBL")
+
+ZERO_REPORT = memoryview(bytes(HID_REPORT_SIZE))
+
+def xor_checksum(data, seed=DDC_CHECKSUM_SEED):
+    return functools.reduce(operator.xor, data, seed)
+
+class ReportEncoder:
+
+    def __init__(self):
+        self.buf = bytearray(HID_REPORT_SIZE)
+        self.view = memoryview(self.buf)
+        # Everything past this is still zero
+        self.used = 0
+
+    # Zeroes whatever the last report left past `end`, returns the buffer.
+    # It gets reused by the next call, so send it before encoding another.
+    def finish(self, end):
+        if end < self.used:
+            self.view[end:self.used] = ZERO_REPORT[end:self.used]
+        self.used = end
+        return self.buf
+
+    def i2c_write(self, i2c_addr, data):
+        data_len = len(data)
+        if data_len > BRIDGE_WRITE_MAX:
+            raise ValueError("I2C write of %d bytes doesn't fit in a report" % data_len)
+        BRIDGE_WRITE.pack_into(self.buf, 0, 0x08, 0x01, 0x55, 0x03, data_len, 0x00, 0x03, i2c_addr)
+        self.buf[8:8+data_len] = data
+        return self.finish(8+data_len)
+
+    def i2c_read(self, i2c_addr, to_read):
+        BRIDGE_READ.pack_into(self.buf, 0, 0x08, 0x02, 0x55, 0x04, to_read, 0x00, 0x0b, i2c_addr)
+        return self.finish(8)
+
+    # A DDC/CI request to `which_device` (0x51 VCP, 0x50 LG special)
+    def ddc_write(self, i2c_addr, which_device, payload):
+        data_len = len(payload)
+        if data_len + 3 > BRIDGE_WRITE_MAX:
+            raise ValueError("DDC/CI message of %d bytes doesn't fit in a report" % data_len)
+        BRIDGE_WRITE.pack_into(self.buf, 0, 0x08, 0x01, 0x55, 0x03, data_len + 3, 0x00, 0x03, i2c_addr)
+        DDC_HEADER.pack_into(self.buf, 8, which_device, data_len)
+        self.buf[10:10+data_len] = payload
+        self.buf[10+data_len] = xor_checksum(self.view[8:10+data_len])
+        return self.finish(11+data_len)
+
+#
+# Copies the payload of a bridge read report into out[offset:], returns how
+# many bytes that was. -1 means the report can't be the answer to a read of
+# `to_read` bytes (leftovers from an exchange we gave up on).
+#
+def decode_read_report(report, to_read, out, offset):
+    if len(report) < BRIDGE_REPLY_HEADER:
+        return -1
+    amt = report[0] - BRIDGE_REPLY_HEADER
+    if amt <= 0 or amt > to_read or BRIDGE_REPLY_HEADER + amt > len(report):
+        return -1
+    out[offset:offset+amt] = memoryview(report)[BRIDGE_REPLY_HEADER:BRIDGE_REPLY_HEADER+amt]
+    return amt
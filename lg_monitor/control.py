@@ -0,0 +1,1379 @@
+import collections
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+
+from lg_monitor.backend import hid_device, hid_enumerate
+from lg_monitor.codec import (
+    HID_REPORT_SIZE, LG_CC_U32, LG_SPECIAL_U16, LG_SPECIAL_U32, LG_SPECIAL_U32_U8,
+    ReportEncoder, decode_read_report, xor_checksum,
+)
+
+#
+# Talking to one monitor: the HID I2C bridge, DDC/CI, LG's 0x50 specials and
+# the reads/writes our patches add, plus the worker thread that owns the
+# connection. Nothing in here knows about the tray, or about any monitor but
+# its own.
+#
+LG_MONITOR_CONTROL_VID = 0x043E
+LG_MONITOR_CONTROL_PID = 0x9A39
+LG_MONITOR_DDCCI_I2C_ADDR = 0x37
+
+# 0 - no split
+# 1 - left-right half and half
+# 2 - top-bottom half and half
+# 3 - left-right 3/4 and 1/4
+# 4 - left-right 1/4 and 3/4
+# 5 - left-right 2/3 and 1/3
+# 6 - 1:1 PIP top left
+# 7 - 1:1 PIP top right
+# 8 - 1:1 PIP bottom left
+# 9 - 1:1 PIP bottom right
+# A - change PIP ratio to 16:9
+# B - three-way, center slightly larger
+# C - also three-way?
+# D - Quad split
+# E - invalid
+LG_SPLIT_NONE = 0x0
+LG_SPLIT_LEFT_RIGHT_HALF_HALF = 0x1
+LG_SPLIT_TOP_BOTTOM = 0x2
+LG_SPLIT_LEFT_RIGHT_3_4__1_4 = 0x3
+LG_SPLIT_LEFT_RIGHT_1_4__3_4 = 0x4
+LG_SPLIT_LEFT_RIGHT_2_3__1_3 = 0x5
+LG_SPLIT_SQUARE_PIP_TOP_LEFT = 0x6
+LG_SPLIT_SQUARE_PIP_TOP_RIGHT = 0x7
+LG_SPLIT_SQUARE_PIP_BOTTOM_LEFT = 0x8
+LG_SPLIT_SQUARE_PIP_BOTTOM_RIGHT = 0x9
+LG_SPLIT_PIP_16_9 = 0xA
+LG_SPLIT_THREE_WAY_SPLIT = 0xB
+LG_SPLIT_THREE_WAY_SPLIT_2 = 0xC
+LG_SPLIT_QUAD_SPLIT = 0xD
+LG_SPLIT_FIX_AUDIO = 0xE
+
+# Split sound source
+LG_SOUND_MAIN = 0
+LG_SOUND_SUB = 1
+
+# LG monitor enum
+LG_MONITOR_HDMI1 = 0
+LG_MONITOR_HDMI2 = 1
+LG_MONITOR_DP1 = 2
+LG_MONITOR_USB_C = 3
+
+# DDC monitor enum
+MONITOR_AUTO = 0x0
+MONITOR_HDMI1 = 0x90
+MONITOR_HDMI2 = 0x91
+MONITOR_DP1 = 0xd0
+MONITOR_DP2 = 0xd1
+MONITOR_DP3 = 0xd2
+MONITOR_USB_C = 0xd2
+
+# Globals
+VCP_D7_SET_1 = 0x002edc61
+VCP_D7_SET_2 = 0x002ee2e8
+VCP_D7_SET_3 = 0x002ee2f9
+VCP_D7_SET_4 = 0x002ee2cb
+VCP_D7_SET_5 = 0x002ee2b2
+
+VCP_D7_GET_1 = 0x0029ef6f
+
+BIG_U32_ADDR = 0x0053b5c0
+
+VCP_83_GET_1 = 0x0029f24b
+
+DDC_50_D1_1 = 0x00297c45
+DDC_50_D1_BURST = DDC_50_D1_1 + 0x2a
+DDC_50_D5_1 = 0x002977f9
+DDC_50_D5_BURST = DDC_50_D5_1 + 0x2b
+DDC_50_D1_CHECKSUM = DDC_50_D1_BURST + 0x43
+DDC_50_DEFAULT_CASE = 0x00297778
+DDC_50_SWITCHTABLE = 0x003a3278
+
+# Max bytes returned by one patched 0xD6 request, the reply is 0x26 bytes
+# with the status byte in front.
+DDC_50_BURST_MAX_READ = 0x20
+
+# Max payload bytes carried by one patched 0xD7 request
+DDC_50_BURST_MAX_WRITE = 0x10
+
+# Unused 0x50 case we point at the checksum routine, and how much it sums up
+# per request (the length is a u16)
+DDC_50_CHECKSUM_CASE = 0x75
+DDC_50_CHECKSUM_MAX = 0xffff
+
+# Max payload bytes per 0xCC 0xF4 arbwrite, DDC/CI messages top out at 32
+# bytes and two of those are the 0xCC 0xF4
+LG_ARBWRITE_MAX = 0x1e
+
+# Patched ranges closer than this get verified with a single read
+PATCH_READ_GAP = 8
+
+# How long (in seconds) shadowed bytes are trusted. The OSD joystick can
+# change MONITOR_INFO_STRUCT under us, patched code only changes on reset/sleep.
+SHADOW_INFO_TTL = 2.0
+SHADOW_CODE_TTL = 60.0
+
+# Reply polling, in seconds. The first read after a request waits for the
+# measured reply latency and backs off exponentially from there.
+REPLY_POLL_INITIAL = 0.01
+REPLY_POLL_MIN = 0.0005
+REPLY_POLL_MAX = 0.2
+
+# What a DDC/CI display sends back when it has nothing ready yet
+DDC_NULL_MESSAGE = bytes([0x6E, 0x80, 0xBE])
+
+# Default deadlines for a whole request, retries included
+VCP_TIMEOUT = 1.0
+LG_SPECIAL_TIMEOUT = 1.0
+
+# How long (in seconds) one begin_read_from_i2c gets for its report to show
+# up, stale reports skipped on the way included
+I2C_READ_TIMEOUT = 0.2
+
+# Upper bounds (in ms) of the TransactionStats latency buckets, anything
+# slower lands in a last overflow bucket
+STATS_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+# Connection states, see LgUsbMonitorControl.link_lost()
+LINK_CLOSED = "closed"
+LINK_CONNECTED = "connected"
+LINK_RECONNECTING = "reconnecting"
+LINK_PATCHING = "patching"
+LINK_FAILED = "failed"
+
+# Reconnect attempts back off from MIN to MAX seconds. After MAX_FAILURES in
+# a row the link counts as failed and only gets one more try per COOLDOWN.
+RECONNECT_BACKOFF_MIN = 0.25
+RECONNECT_BACKOFF_MAX = 8.0
+RECONNECT_MAX_FAILURES = 6
+RECONNECT_COOLDOWN = 60.0
+
+# DeviceWorker priorities, lower goes first. Menu clicks beat plain calls,
+# which beat the heartbeat and the memory watcher.
+PRIORITY_USER = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# Where the "Dump stats" menu item writes to
+STATS_DUMP_PATH = os.path.expanduser("~/lg_display_manager_stats.json")
+
+SPLIT_5_ADDR = 0x002ee2de
+SPLIT_3_ADDR = 0x002ee2fa
+
+MONITOR_INFO_STRUCT = 0x005d5928
+
+# Raised by anything that talks to the monitor while the link is down, the
+# reconnect runs in the background and the caller can try again later
+class DeviceDisconnected(Exception):
+    pass
+
+# Raised when the monitor keeps answering an arbread/arbwrite with a bad
+# status (or not at all) until the timeout runs out
+class DeviceTimeout(Exception):
+    pass
+
+#
+# Helpers
+#
+def msg_checksum(msg):
+    return xor_checksum(msg, 0x6E^0x50)
+
+def msg_add_checksum(msg):
+    msg += [xor_checksum(msg[8:])]
+    return msg
+
+def msg_add_checksum_2(msg):
+    msg += [xor_checksum(msg)]
+    return msg
+
+# DDC/CI VCP replies are [0x6E, 0x80 | len, opcode, ...payload, checksum].
+# Returns the reply if the header, checksum and opcode/VCP echo all match the
+# request, otherwise None.
+def parse_vcp_reply(data, opcode, idx):
+    if len(data) < 0xb:
+        return None
+    if data[0] != 0x6E or not (data[1] & 0x80):
+        return None
+
+    data_len = data[1] & 0x7F
+    if data_len > len(data)-1-2:
+        return None
+    if msg_checksum(data[1:1+data_len+2]) != 0:
+        return None
+
+    if opcode is not None and data[2] != opcode:
+        return None
+    if data[4] != idx:
+        return None
+    return data
+
+def hex_dump(b, prefix=""):
+    p = prefix
+    b = bytes(b)
+    for i in range(0, len(b)):
+        if i != 0 and i % 16 == 0:
+            print (p)
+            p = prefix
+        p += ("%02x " % b[i])
+    print (p)
+    print ("")
+
+# Flattens (addr, bytes) writes into sorted, non-overlapping runs, later
+# writes win.
+def merge_ranges(writes):
+    image = {}
+    for addr, val in writes:
+        for i in range(0, len(val)):
+            image[addr+i] = val[i]
+
+    ranges = []
+    for addr in sorted(image):
+        if ranges and ranges[-1][0] + len(ranges[-1][1]) == addr:
+            ranges[-1][1].append(image[addr])
+        else:
+            ranges += [(addr, [image[addr]])]
+    return ranges
+
+# Same sum the patched 0x50 0x75 routine runs on the monitor: a is the sum of
+# the bytes, b the sum of a after each byte, both mod 2**32. Cheap enough for
+# the AEON to do without a table, and unlike a plain sum it notices bytes
+# that moved. Returned as (a << 32) | b.
+def region_checksum_data(data):
+    a = 0
+    b = 0
+    for val in data:
+        a = (a + val) & 0xFFFFFFFF
+        b = (b + a) & 0xFFFFFFFF
+    return (a << 32) | b
+
+# Checksum of two ranges back to back, given the second one's length
+def region_checksum_combine(first, second, second_len):
+    a1 = first >> 32
+    b1 = first & 0xFFFFFFFF
+    a2 = second >> 32
+    b2 = second & 0xFFFFFFFF
+    a = (a1 + a2) & 0xFFFFFFFF
+    b = (b1 + b2 + a1 * second_len) & 0xFFFFFFFF
+    return (a << 32) | b
+
+# Groups sorted ranges into (addr, len) spans that can be read back together
+def read_spans(ranges, gap=PATCH_READ_GAP):
+    spans = []
+    for addr, val in ranges:
+        if spans and addr - (spans[-1][0] + spans[-1][1]) <= gap:
+            spans[-1] = (spans[-1][0], addr + len(val) - spans[-1][0])
+        else:
+            spans += [(addr, len(val))]
+    return spans
+
+#
+# Host-side copy of monitor RAM we've read or written, only for the ranges
+# registered with add_range.
+#
+class ShadowMemory:
+
+    def __init__(self):
+        self.ranges = []
+        self.mem = dict()
+
+    def add_range(self, addr, data_len, ttl):
+        self.ranges += [(addr, data_len, ttl)]
+
+    def ttl_for(self, addr):
+        for start, data_len, ttl in self.ranges:
+            if addr >= start and addr < start + data_len:
+                return ttl
+        return None
+
+    # Returns None unless every byte is cached and fresh
+    def get(self, addr, data_len):
+        now = time.monotonic()
+        vals = []
+        for i in range(0, data_len):
+            if addr+i not in self.mem:
+                return None
+            val, expires = self.mem[addr+i]
+            if now >= expires:
+                return None
+            vals += [val]
+        return vals
+
+    def put(self, addr, vals):
+        now = time.monotonic()
+        end = addr + len(vals)
+        # Last range first, so whichever comes first wins like in ttl_for()
+        for start, data_len, ttl in reversed(self.ranges):
+            expires = now + ttl
+            for i in range(max(addr, start), min(end, start + data_len)):
+                self.mem[i] = (vals[i-addr], expires)
+
+    def invalidate(self, addr=None, data_len=1):
+        if addr is None:
+            self.mem = dict()
+            return
+        for i in range(0, data_len):
+            self.mem.pop(addr+i, None)
+
+#
+# Tracks how long the monitor takes to have a reply ready, so we don't sleep
+# longer than needed before reading it back.
+#
+class ReplyPoller:
+
+    def __init__(self, initial=REPLY_POLL_INITIAL):
+        self.estimate = initial
+
+    def delay(self, attempt):
+        return min(self.estimate * (2 ** attempt), REPLY_POLL_MAX)
+
+    def record(self, attempt, delay):
+        if attempt == 0:
+            # Worked first time, see if it's ready any sooner
+            self.estimate = max(self.estimate * 0.95, REPLY_POLL_MIN)
+        else:
+            self.estimate = min((self.estimate + delay) / 2, REPLY_POLL_MAX)
+
+#
+# Latency histograms and event counters per operation ("send_raw",
+# "get_vcp", "lg_special_d1", ...). Cheap enough to leave on all the time.
+#
+class TransactionStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.ops = dict()
+
+    def op(self, name):
+        if name not in self.ops:
+            self.ops[name] = {
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "buckets": [0] * (len(STATS_BUCKETS_MS) + 1),
+                "events": dict(),
+            }
+        return self.ops[name]
+
+    def record(self, name, seconds):
+        ms = seconds * 1000
+        bucket = len(STATS_BUCKETS_MS)
+        for i in range(0, len(STATS_BUCKETS_MS)):
+            if ms <= STATS_BUCKETS_MS[i]:
+                bucket = i
+                break
+
+        with self.lock:
+            op = self.op(name)
+            op["count"] += 1
+            op["total_ms"] += ms
+            op["max_ms"] = max(op["max_ms"], ms)
+            op["buckets"][bucket] += 1
+
+    # Counts things like "retries", "short_reads", "bad_status", "timeouts"
+    def count(self, name, event, amt=1):
+        if amt <= 0:
+            return
+        with self.lock:
+            events = self.op(name)["events"]
+            events[event] = events.get(event, 0) + amt
+
+    def snapshot(self):
+        with self.lock:
+            ops = dict()
+            for name in self.ops:
+                op = self.ops[name]
+                ops[name] = dict(op, buckets=list(op["buckets"]), events=dict(op["events"]))
+        return {"started": self.started, "now": time.time(), "buckets_ms": STATS_BUCKETS_MS, "ops": ops}
+
+    def report(self):
+        snap = self.snapshot()
+        lines = ["%-20s %8s %9s %9s  %s" % ("op", "count", "avg ms", "max ms", "events")]
+        for name in sorted(snap["ops"]):
+            op = snap["ops"][name]
+            avg = op["total_ms"] / op["count"] if op["count"] else 0.0
+            events = " ".join("%s=%u" % (k, op["events"][k]) for k in sorted(op["events"]))
+            lines += ["%-20s %8u %9.2f %9.2f  %s" % (name, op["count"], avg, op["max_ms"], events)]
+        return "\n".join(lines)
+
+    def dump(self, fpath=STATS_DUMP_PATH):
+        with open(fpath, "w") as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        return fpath
+
+# Which of a monitor's HID interfaces an enumerate entry is. Some platforms
+# list an interface once per usage, so that's part of it too.
+def hid_interface(info):
+    return (info.get("interface_number", -1), info.get("usage_page", 0), info.get("usage", 0))
+
+#
+# Every monitor on the bus as (path, serial). A monitor can show up once per
+# HID interface, hid.device().open() goes with the first one so we do too,
+# and only entries for that same interface count. Without a serial the path
+# is all that tells monitors apart, and it differs per interface.
+#
+def enumerate_monitors(enumerate_fn=None):
+    if enumerate_fn is None:
+        enumerate_fn = hid_enumerate
+
+    infos = list(enumerate_fn(LG_MONITOR_CONTROL_VID, LG_MONITOR_CONTROL_PID))
+    if not infos:
+        return []
+    bridge = hid_interface(infos[0])
+
+    found = []
+    seen = set()
+    for info in infos:
+        if hid_interface(info) != bridge:
+            continue
+        serial = info.get("serial_number") or None
+        key = serial or info["path"]
+        if key in seen:
+            continue
+        seen.add(key)
+        found += [(info["path"], serial)]
+    return found
+
+class LgUsbMonitorControl:
+
+    # backend: callable returning a hid.device()-like object, for running
+    # against something other than the real monitor
+    # path/serial: which monitor, from enumerate_monitors(). Without a path
+    # whatever hid opens first for the VID/PID gets used.
+    # enumerate_fn: what enumerate_monitors() looks the path up again with
+    # on a reopen, hid.enumerate() if None
+    def __init__(self, backend=None, path=None, serial=None, enumerate_fn=None):
+        # USB
+        self.backend = backend
+        self.path = path
+        self.serial = serial
+        self.enumerate_fn = enumerate_fn
+        self.has_usb = False
+        self.dev = None
+        self.ep_in = None
+        self.ep_out = None
+
+        # Set by run_patches once the 0xD6 burst read patch checks out
+        self.has_burst_read = False
+        # Set by run_patches once the 0xD7 burst write patch checks out
+        self.has_burst_write = False
+        # Set by run_patches once the 0x75 checksum patch checks out
+        self.has_region_checksum = False
+
+        # (model, scalar version) once startup() has checked it
+        self.firmware = None
+
+        # What VCP 0xD7 was last set to or read back as, (split, expires)
+        self.split_cache = None
+
+        # PatchPlanner for this monitor, see load_patch_planner()
+        self.patch_planner = None
+
+        # Runs on the reconnect thread once the monitor is back, before anyone
+        # else gets to use it. run_patches() points it at itself.
+        self.repair = None
+
+        # When heartbeat() last ran, to notice sleeps
+        self.last_heartbeat = None
+
+        # Connection state machine, see link_lost()
+        self.link_state = LINK_CLOSED
+        self.link_lock = threading.Lock()
+        self.link_up = threading.Event()
+        self.link_failures = 0
+        self.link_error = None
+        self.reconnect_thread = None
+
+        # When not None, lg_arbwrite/my_arbwrite queue (atomic, addr, bytes)
+        # here until the write_batch() they're in is done
+        self.batched_writes = None
+
+        # One per DDC/CI source address, 0x51 (VCP) and 0x50 (LG special)
+        # don't answer equally fast
+        self.pollers = dict()
+
+        self.shadow = ShadowMemory()
+        self.shadow.add_range(MONITOR_INFO_STRUCT, 0x1000, SHADOW_INFO_TTL)
+
+        self.stats = TransactionStats()
+
+        # Builds every outgoing report, see codec.py
+        self.encoder = ReportEncoder()
+
+        # The DeviceWorker running our commands, if any, and how many
+        # critical() blocks we're in
+        self.worker = None
+        self.critical_depth = 0
+
+    def init_usb(self):
+        self.open_usb()
+        with self.link_lock:
+            self.link_failures = 0
+            self.set_link_state(LINK_CONNECTED)
+
+    def open_usb(self):
+        # Whatever we knew about the monitor may be stale after a reconnect
+        self.shadow.invalidate()
+        self.split_cache = None
+
+        if self.backend is not None:
+            self.dev = self.backend()
+        else:
+            self.dev = hid_device()
+        if self.path is not None:
+            self.dev.open_path(self.find_path())
+        else:
+            self.dev.open(LG_MONITOR_CONTROL_VID, LG_MONITOR_CONTROL_PID)
+
+        self.has_usb = True
+
+    # hidraw nodes and IOService paths change when the monitor is replugged,
+    # so one we know the serial of gets looked up again
+    def find_path(self):
+        if self.serial:
+            try:
+                for path, serial in enumerate_monitors(self.enumerate_fn):
+                    if serial == self.serial:
+                        self.path = path
+                        break
+            except OSError as e:
+                print ("Couldn't enumerate monitors", e)
+        return self.path
+
+    # For logs and menus
+    def describe(self):
+        if self.serial:
+            return self.serial
+        if self.path is not None:
+            return self.path.decode("utf-8", "replace") if isinstance(self.path, bytes) else str(self.path)
+        return "monitor"
+
+    #
+    # The link goes:
+    #
+    #   closed -> connected (init_usb)
+    #   connected -> reconnecting (a HID read/write threw)
+    #   reconnecting -> patching (reopened, now draining and re-patching)
+    #   patching -> connected, or back to reconnecting if that threw too
+    #   reconnecting -> failed (RECONNECT_MAX_FAILURES in a row)
+    #   failed -> patching (one more go every RECONNECT_COOLDOWN)
+    #
+    # Everything but the reconnect thread gets DeviceDisconnected right away
+    # while it isn't connected, instead of waiting on (or recursing into) the
+    # recovery.
+    #
+    # Only call with link_lock held
+    def set_link_state(self, state):
+        if state == self.link_state:
+            return
+        self.link_state = state
+        if state == LINK_CONNECTED:
+            self.link_up.set()
+        else:
+            self.link_up.clear()
+
+    def check_link(self):
+        state = self.link_state
+        if state == LINK_CONNECTED:
+            return
+        if state == LINK_PATCHING and threading.current_thread() is self.reconnect_thread:
+            return
+        raise DeviceDisconnected(self.describe() + " is " + state)
+
+    # Marks the link as down, kicks off the reconnect if it isn't running and
+    # raises DeviceDisconnected
+    def link_lost(self, e):
+        with self.link_lock:
+            if self.link_state == LINK_CONNECTED:
+                self.stats.count("usb", "disconnects")
+            self.has_usb = False
+            self.link_error = e
+            if self.link_state != LINK_FAILED:
+                self.set_link_state(LINK_RECONNECTING)
+            try:
+                self.dev.close()
+            except Exception:
+                pass
+
+            if self.reconnect_thread is None:
+                self.reconnect_thread = threading.Thread(target=self.reconnect, name="lg_reconnect", daemon=True)
+                self.reconnect_thread.start()
+        raise DeviceDisconnected(self.describe() + " went away: " + str(e)) from e
+
+    def reconnect(self):
+        while True:
+            if self.link_failures >= RECONNECT_MAX_FAILURES:
+                with self.link_lock:
+                    self.set_link_state(LINK_FAILED)
+                time.sleep(RECONNECT_COOLDOWN)
+            else:
+                time.sleep(min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_MIN * (2 ** self.link_failures)))
+
+            try:
+                self.open_usb()
+                with self.link_lock:
+                    self.set_link_state(LINK_PATCHING)
+
+                # Drain anything waiting
+                self.drain_stale()
+                if self.repair is not None:
+                    self.repair(self)
+            except Exception as e:
+                print ("Reconnect failed:", e)
+                self.stats.count("usb", "reconnect_failures")
+                with self.link_lock:
+                    self.has_usb = False
+                    self.link_error = e
+                    self.link_failures += 1
+                    if self.link_state != LINK_FAILED:
+                        self.set_link_state(LINK_RECONNECTING)
+                continue
+
+            self.stats.count("usb", "reconnects")
+            with self.link_lock:
+                self.link_failures = 0
+                self.link_error = None
+                self.reconnect_thread = None
+                self.set_link_state(LINK_CONNECTED)
+            return
+
+    # For callers that would rather wait out a reconnect than fail
+    def wait_connected(self, timeout=None):
+        return self.link_up.wait(timeout)
+
+    # Lets queued commands that outrank the running one go first. Only ever
+    # called between whole exchanges, and does nothing inside a write batch
+    # or critical().
+    def yield_point(self):
+        if self.worker is None or self.batched_writes is not None or self.critical_depth:
+            return
+        self.worker.run_preempting()
+
+    # For anything that mustn't have other commands run in the middle of it,
+    # like putting the patches back
+    @contextlib.contextmanager
+    def critical(self):
+        self.critical_depth += 1
+        try:
+            yield
+        finally:
+            self.critical_depth -= 1
+
+    # Throws away reports nobody is waiting for, without blocking. Returns how
+    # many were dropped. Only whoever owns the link may touch the handle, so
+    # while it's being re-patched this raises DeviceDisconnected for
+    # everyone but the reconnect thread.
+    def drain_stale(self):
+        if self.link_state == LINK_CLOSED or not self.has_usb:
+            return 0
+        self.check_link()
+
+        dropped = 0
+        try:
+            self.dev.set_nonblocking(1)
+            for i in range(0, 0x10):
+                if not self.dev.read(0x40):
+                    break
+                dropped += 1
+        except Exception as e:
+            print ("Failed to drain", e)
+        finally:
+            try:
+                self.dev.set_nonblocking(0)
+            except Exception:
+                pass
+        self.stats.count("usb", "stale_reports", dropped)
+        return dropped
+
+    # pkt: normally a full report from self.encoder, anything shorter gets
+    # zero padded
+    def send_raw(self, pkt):
+        if self.link_state == LINK_CLOSED:
+            return
+        self.check_link()
+
+        if len(pkt) < HID_REPORT_SIZE:
+            pkt = bytes(pkt) + bytes(HID_REPORT_SIZE - len(pkt))
+
+        start = time.perf_counter()
+        try:
+            self.dev.write(pkt)
+        except Exception as e:
+            print ("Failed to write", e)
+            self.stats.count("send_raw", "errors")
+            self.link_lost(e)
+        self.stats.record("send_raw", time.perf_counter() - start)
+
+    def read_raw(self, amt=0x40, timeout=200):
+        if self.link_state == LINK_CLOSED:
+            return
+        self.check_link()
+
+        start = time.perf_counter()
+        try:
+            data = bytes(self.dev.read(amt, timeout))
+        except Exception as e:
+            print ("Failed to read", e)
+            self.stats.count("read_raw", "errors")
+            self.link_lost(e)
+        self.stats.record("read_raw", time.perf_counter() - start)
+        if not data:
+            self.stats.count("read_raw", "empty")
+        return data
+
+    def send_to_i2c(self, addr, data):
+        wrapped = self.encoder.i2c_write(addr, data)
+        #hex_dump(wrapped)
+        self.send_raw(wrapped)
+
+    def begin_read_from_i2c(self, addr, to_read):
+        wrapped = self.encoder.i2c_read(addr, to_read)
+        #hex_dump(wrapped)
+        self.send_raw(wrapped)
+
+    # Returns a bytearray, cut short if the monitor stopped answering. DDC/CI
+    # gets read 0x10 bytes at a time, the ISP flash port takes up to 0x3C.
+    # Each chunk waits I2C_READ_TIMEOUT at most for its report, or less if
+    # `deadline` (time.monotonic()) comes first.
+    def read_from_i2c(self, addr, expected_back, delay=0.01, chunk=0x10, deadline=None):
+        if expected_back <= 0:
+            return bytearray()
+
+        data = bytearray(expected_back)
+        got = 0
+
+        time.sleep(delay)
+        while got < expected_back:
+            to_read = chunk
+            if to_read > expected_back - got:
+                to_read = expected_back - got
+            self.begin_read_from_i2c(addr, to_read)
+        
+            # Skip over anything stale until our report shows up, the reads
+            # all come out of the same wait
+            chunk_deadline = time.monotonic() + I2C_READ_TIMEOUT
+            if deadline is not None:
+                chunk_deadline = min(chunk_deadline, deadline)
+            amt = -1
+            while True:
+                remaining = chunk_deadline - time.monotonic()
+                data_tmp = self.read_raw(0x100, max(int(remaining * 1000), 1))
+                if not data_tmp:
+                    break
+                amt = decode_read_report(data_tmp, to_read, data, got)
+                if amt >= 0:
+                    break
+                self.stats.count("read_from_i2c", "stale_reports")
+                if time.monotonic() >= chunk_deadline:
+                    break
+            if amt < 0:
+                self.stats.count("read_from_i2c", "short_reads")
+                break
+
+            got += amt
+
+        if got < expected_back:
+            del data[got:]
+        return data
+    
+    def wrap_send_vcp_2(self, data, expected_back=0xb, delay=0.01, deadline=None):
+        return self.wrap_send_vcp_4(data, expected_back, 0x51, delay, deadline)
+    
+    def wrap_send_vcp_3(self, data, expected_back=0xb, delay=0.01, deadline=None):
+        return self.wrap_send_vcp_4(data, expected_back, 0x50, delay, deadline)
+    
+    def wrap_send_vcp_4(self, data, expected_back=0xb, which_device=0x51, delay=0.01, deadline=None):
+        # Anything still queued up is from an exchange we already gave up on
+        self.drain_stale()
+
+        self.send_raw(self.encoder.ddc_write(LG_MONITOR_DDCCI_I2C_ADDR, which_device, data))
+        
+        return self.read_from_i2c(LG_MONITOR_DDCCI_I2C_ADDR, expected_back, delay, deadline=deadline)
+
+    def poller_for(self, which_device):
+        if which_device not in self.pollers:
+            self.pollers[which_device] = ReplyPoller()
+        return self.pollers[which_device]
+    
+    def get_vcp(self, idx, timeout=VCP_TIMEOUT):
+        poller = self.poller_for(0x51)
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        tries = 0
+        while True:
+            delay = poller.delay(attempt)
+            data = self.wrap_send_vcp_2([0x01, idx], delay=delay, deadline=deadline)
+            tries += 1
+            
+            #hex_dump(data)
+            reply = parse_vcp_reply(data, 0x02, idx)
+            if reply is not None:
+                poller.record(attempt, delay)
+                self.stats.record("get_vcp", time.perf_counter() - start)
+                self.stats.count("get_vcp", "retries", tries-1)
+                return reply[9] | reply[8] << 8
+
+            # Only wait longer if it wasn't ready, a lost request isn't slow
+            if bytes(data[0:3]) == DDC_NULL_MESSAGE:
+                attempt += 1
+            if time.monotonic() + poller.delay(attempt) >= deadline:
+                self.stats.count("get_vcp", "retries", tries-1)
+                self.stats.count("get_vcp", "timeouts")
+                return -1
+    
+    def set_vcp(self, idx, val, val2=0, timeout=VCP_TIMEOUT):
+        poller = self.poller_for(0x51)
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        tries = 0
+        while True:
+            delay = poller.delay(attempt)
+            data = self.wrap_send_vcp_2(LG_SPECIAL_U16.pack(0x03, idx, val & 0xFFFF), delay=delay, deadline=deadline)
+            tries += 1
+            
+            #hex_dump(data)
+            reply = parse_vcp_reply(data, None, idx)
+            if reply is not None:
+                poller.record(attempt, delay)
+                self.stats.record("set_vcp", time.perf_counter() - start)
+                self.stats.count("set_vcp", "retries", tries-1)
+                return reply[9]
+
+            # Only wait longer if it wasn't ready, a lost request isn't slow
+            if bytes(data[0:3]) == DDC_NULL_MESSAGE:
+                attempt += 1
+            if time.monotonic() + poller.delay(attempt) >= deadline:
+                self.stats.count("set_vcp", "retries", tries-1)
+                self.stats.count("set_vcp", "timeouts")
+                return -1
+
+    # Sends an LG special (0x50) request and polls for its 0x26 byte reply,
+    # returns None if nothing full-sized came back before the deadline.
+    def lg_special_request(self, data, timeout=LG_SPECIAL_TIMEOUT):
+        name = "lg_special_%02x" % data[1]
+        poller = self.poller_for(0x50)
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        tries = 0
+        while True:
+            delay = poller.delay(attempt)
+            reply = self.wrap_send_vcp_3(data, 0x26, delay, deadline)
+            tries += 1
+
+            #hex_dump(reply)
+            if bytes(reply[0:3]) == DDC_NULL_MESSAGE:
+                # Asked too early, the rest is zero padding. Only this backs
+                # off, a lost request isn't a slow one.
+                self.stats.count(name, "not_ready")
+                attempt += 1
+            elif (len(reply) >= 0x26):
+                poller.record(attempt, delay)
+                self.stats.record(name, time.perf_counter() - start)
+                self.stats.count(name, "retries", tries-1)
+                return reply
+            else:
+                self.stats.count(name, "short_reads")
+
+            if time.monotonic() + poller.delay(attempt) >= deadline:
+                self.stats.count(name, "retries", tries-1)
+                self.stats.count(name, "timeouts")
+                return None
+
+    def lg_special(self, idx, val, timeout=LG_SPECIAL_TIMEOUT):
+        data = self.lg_special_request(LG_SPECIAL_U16.pack(0x03, idx, val & 0xFFFF), timeout)
+        if data is None:
+            return bytes([])
+        return data
+
+    def lg_special_u32(self, idx, val, timeout=LG_SPECIAL_TIMEOUT):
+        data = self.lg_special_request(LG_SPECIAL_U32.pack(0x03, idx, val), timeout)
+        if data is None:
+            return bytes([0,0,0,0,0,0,0,0,0,0])
+        return data
+
+    def lg_special_u32_u8(self, idx, val, val2, timeout=LG_SPECIAL_TIMEOUT):
+        data = self.lg_special_request(LG_SPECIAL_U32_U8.pack(0x03, idx, val, val2), timeout)
+        if data is None:
+            return bytes([0,0,0,0,0,0,0,0,0,0])
+        return data
+
+    def lg_special_u32_data(self, idx, val, val2, timeout=LG_SPECIAL_TIMEOUT):
+        data = self.lg_special_request(LG_SPECIAL_U32.pack(0x03, idx, val) + bytes(val2), timeout)
+        if data is None:
+            return bytes([0,0,0,0,0,0,0,0,0,0])
+        return data
+
+    def lg_special_f3(self, val):
+        for i in range(0, 1):
+            data = self.wrap_send_vcp_4([0xf3,(val >> 8) & 0xFF, val & 0xFF], 0x26)
+
+        hex_dump(data)
+        return data
+
+    def lg_special_cc_data(self, idx, val):
+        data = self.wrap_send_vcp_4([0xcc,idx] + val, 0)
+        return data
+    
+    def lg_special_cc_u32(self, idx, val):
+        data = self.wrap_send_vcp_4(LG_CC_U32.pack(0xcc, idx, val & 0xFFFFFFFF), 0)
+        return data
+    
+    # Not atomic
+    def lg_arbwrite_str16(self, addr, val):
+        self.lg_arbwrite(addr, list(val.encode("utf-16"))[2:] + [0,0])
+    
+    def lg_arbwrite_u32(self, addr, val):
+        self.lg_arbwrite(addr, list(struct.pack("<L", val)))
+    
+    def lg_arbwrite_u16(self, addr, val):
+        self.lg_arbwrite(addr, list(struct.pack("<H", val)))
+    
+    def lg_arbwrite_u8(self, addr, val):
+        self.lg_arbwrite(addr, [val & 0xFF])
+    
+    def lg_arbwrite_u32_be(self, addr, val):
+        self.lg_arbwrite(addr, list(struct.pack(">L", val)))
+
+    def lg_arbwrite_u24_be(self, addr, val):
+        self.lg_arbwrite_u16_be(addr, val>>8)
+        self.lg_arbwrite_u8(addr+2, val & 0xFF)
+        
+    def lg_arbwrite_u16_be(self, addr, val):
+        self.lg_arbwrite(addr, list(struct.pack(">H", val)))
+    
+    # The 0xCC commands never answer, so `timeout` only catches the bridge
+    # itself stalling on a chunk. Batched writes go out with the default.
+    def lg_arbwrite(self, addr, val, timeout=LG_SPECIAL_TIMEOUT):
+        val = list(val)
+
+        # These can get dropped, so don't pretend we know what's there now
+        self.shadow.invalidate(addr, len(val))
+
+        if self.batched_writes is not None:
+            self.batched_writes += [(False, addr, val)]
+            return
+
+        for i in range(0, len(val), LG_ARBWRITE_MAX):
+            deadline = time.monotonic() + timeout
+            self.lg_special_cc_u32(0xf6, addr+i)
+            self.lg_special_cc_u32(0xf6, addr+i)
+            self.lg_special_cc_data(0xf4, val[i:i+LG_ARBWRITE_MAX])
+            if time.monotonic() >= deadline:
+                self.stats.count("lg_arbwrite", "timeouts")
+                raise DeviceTimeout("arbwrite at %08x took over %.1fs" % (addr+i, timeout))
+
+    # Atomic
+    def my_arbwrite_str16(self, addr, val):
+        self.my_arbwrite(addr, list(val.encode("utf-16"))[2:] + [0,0])
+    
+    def my_arbwrite_u32(self, addr, val):
+        self.my_arbwrite(addr, list(struct.pack("<L", val)))
+    
+    def my_arbwrite_u16(self, addr, val):
+        self.my_arbwrite(addr, list(struct.pack("<H", val)))
+    
+    def my_arbwrite_u8(self, addr, val):
+        self.my_arbwrite(addr, [val & 0xFF])
+    
+    def my_arbwrite_u32_be(self, addr, val):
+        self.my_arbwrite(addr, list(struct.pack(">L", val)))
+
+    def my_arbwrite_u24_be(self, addr, val):
+        self.my_arbwrite_u16_be(addr, val>>8)
+        self.my_arbwrite_u8(addr+2, val & 0xFF)
+        
+    def my_arbwrite_u16_be(self, addr, val):
+        self.my_arbwrite(addr, list(struct.pack(">H", val)))
+    
+    # Each byte gets `timeout` to be acked before DeviceTimeout
+    def my_arbwrite_bytewise(self, addr, val, timeout=LG_SPECIAL_TIMEOUT):
+        for i in range(0, len(val)):
+            deadline = time.monotonic() + timeout
+            while self.lg_special_u32_u8(0xd5, addr+i, val[i], timeout)[0] != 0x82:
+                self.stats.count("my_arbwrite", "bad_status")
+                if time.monotonic() >= deadline:
+                    self.stats.count("my_arbwrite", "timeouts")
+                    raise DeviceTimeout("arbwrite at %08x not acked in %.1fs" % (addr+i, timeout))
+
+    # Returns False if the 0xD7 patch isn't answering
+    def my_arbwrite_burst(self, addr, val, timeout=LG_SPECIAL_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        for i in range(0, 10):
+            data = self.lg_special_u32_data(0xd7, addr, [len(val)] + val, timeout)
+            if data[0] == 0x82:
+                return True
+            self.stats.count("my_arbwrite_burst", "bad_status")
+            if time.monotonic() >= deadline:
+                break
+        return False
+
+    # `timeout` is per exchange (one chunk or byte), not for the whole write
+    def my_arbwrite(self, addr, val, timeout=LG_SPECIAL_TIMEOUT):
+        val = list(val)
+        if self.batched_writes is not None:
+            self.batched_writes += [(True, addr, val)]
+            return
+
+        # Whatever was shadowed there is out of date either way, and the new
+        # bytes only go in once all of them were acked
+        self.shadow.invalidate(addr, len(val))
+
+        if not self.has_burst_write or len(val) <= 1:
+            self.my_arbwrite_bytewise(addr, val, timeout)
+            self.shadow.put(addr, val)
+            return
+
+        for i in range(0, len(val), DDC_50_BURST_MAX_WRITE):
+            chunk = val[i:i+DDC_50_BURST_MAX_WRITE]
+            if not self.my_arbwrite_burst(addr+i, chunk, timeout):
+                # Patch got lost (sleep?), finish up the slow way
+                self.stats.count("my_arbwrite", "burst_fallbacks")
+                self.has_burst_write = False
+                self.my_arbwrite_bytewise(addr+i, val[i:], timeout)
+                break
+        self.shadow.put(addr, val)
+
+    #
+    # Queues up lg_arbwrite/my_arbwrite calls and sends them on the way out,
+    # with overlapping and adjacent writes merged into as few transfers as
+    # possible:
+    #
+    #   with device.write_batch():
+    #       device.lg_arbwrite_u24_be(...)
+    #       device.lg_arbwrite_u24_be(...)
+    #
+    # Reads inside the batch don't see the queued writes. Nested batches are
+    # flushed by the outermost one, nothing is sent if the block raises.
+    #
+    @contextlib.contextmanager
+    def write_batch(self):
+        if self.batched_writes is not None:
+            yield
+            return
+
+        self.batched_writes = []
+        try:
+            yield
+            writes = self.batched_writes
+        finally:
+            self.batched_writes = None
+        self.flush_writes(writes)
+
+    def flush_writes(self, writes):
+        # Non-atomic and atomic writes can land on the same bytes, so only
+        # merge runs of the same kind and keep those runs in order
+        i = 0
+        while i < len(writes):
+            atomic = writes[i][0]
+            j = i
+            while j < len(writes) and writes[j][0] == atomic:
+                j += 1
+
+            for addr, val in merge_ranges([(w[1], w[2]) for w in writes[i:j]]):
+                if atomic:
+                    self.my_arbwrite(addr, val)
+                else:
+                    self.lg_arbwrite(addr, val)
+            i = j
+
+    # Also atomic
+    def lg_arbread_u32(self, addr, timeout=LG_SPECIAL_TIMEOUT):
+        return struct.unpack("<L", bytes(self.lg_arbread_data(addr, 4, timeout=timeout)))[0]
+
+    def lg_arbread_u16(self, addr, timeout=LG_SPECIAL_TIMEOUT):
+        return struct.unpack("<H", bytes(self.lg_arbread_data(addr, 2, timeout=timeout)))[0]
+
+    def lg_arbread_u32_be(self, addr, timeout=LG_SPECIAL_TIMEOUT):
+        return struct.unpack(">L", bytes(self.lg_arbread_data(addr, 4, timeout=timeout)))[0]
+
+    def lg_arbread_u16_be(self, addr, timeout=LG_SPECIAL_TIMEOUT):
+        return struct.unpack(">H", bytes(self.lg_arbread_data(addr, 2, timeout=timeout)))[0]
+
+    # Raises DeviceTimeout if nothing good came back within `timeout`
+    def lg_arbread_u8(self, addr, timeout=LG_SPECIAL_TIMEOUT):
+        cached = self.shadow.get(addr, 1)
+        if cached is not None:
+            return cached[0]
+
+        # Struct fields tend to get read together, so pull in the whole
+        # neighbourhood while we're at it
+        if self.has_burst_read and self.shadow.ttl_for(addr) is not None:
+            start = addr & ~(DDC_50_BURST_MAX_READ-1)
+            chunk = self.lg_arbread_burst(start, DDC_50_BURST_MAX_READ, timeout)
+            if chunk is not None:
+                self.shadow.put(start, chunk)
+                return chunk[addr-start]
+
+        deadline = time.monotonic() + timeout
+        data = self.lg_special_u32(0xd1, addr, timeout)
+        while data[0] != 0x82:
+            self.stats.count("lg_arbread_u8", "bad_status")
+            if time.monotonic() >= deadline:
+                self.stats.count("lg_arbread_u8", "timeouts")
+                raise DeviceTimeout("arbread at %08x not answered in %.1fs" % (addr, timeout))
+            data = self.lg_special_u32(0xd1, addr, max(deadline - time.monotonic(), 0.0))
+        val = data[1]
+        self.shadow.put(addr, [val])
+        return val
+
+    # Returns None if the 0xD6 patch isn't answering
+    def lg_arbread_burst(self, addr, data_len, timeout=LG_SPECIAL_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        for i in range(0, 10):
+            data = self.lg_special_u32_u8(0xd6, addr, data_len, timeout)
+            if data[0] == 0x82:
+                return list(data[1:1+data_len])
+            self.stats.count("lg_arbread_burst", "bad_status")
+            if time.monotonic() >= deadline:
+                break
+        return None
+
+    def lg_arbread_data_bytewise(self, addr, data_len, timeout=LG_SPECIAL_TIMEOUT):
+        vals = []
+        for i in range(0, data_len):
+            val = self.lg_arbread_u8(addr+i, timeout)
+            #print (hex(i),hex(val))
+            vals += [val]
+        return vals
+
+    # `timeout` is per exchange (one chunk or byte), not for the whole read
+    def lg_arbread_data(self, addr, data_len, use_cache=True, timeout=LG_SPECIAL_TIMEOUT):
+        if use_cache:
+            cached = self.shadow.get(addr, data_len)
+            if cached is not None:
+                return cached
+        else:
+            self.shadow.invalidate(addr, data_len)
+
+        if not self.has_burst_read:
+            return self.lg_arbread_data_bytewise(addr, data_len, timeout)
+
+        vals = []
+        for i in range(0, data_len, DDC_50_BURST_MAX_READ):
+            if i:
+                self.yield_point()
+            to_read = min(DDC_50_BURST_MAX_READ, data_len - i)
+            chunk = self.lg_arbread_burst(addr+i, to_read, timeout)
+            if chunk is None:
+                # Patch got lost (sleep?), finish up the slow way
+                self.stats.count("lg_arbread_data", "burst_fallbacks")
+                self.has_burst_read = False
+                return vals + self.lg_arbread_data_bytewise(addr+i, data_len-i, timeout)
+            self.shadow.put(addr+i, chunk)
+            vals += chunk
+        return vals
+
+    # One exchange, returns None if the 0x75 patch isn't answering. Raises
+    # DeviceTimeout if nothing good came back within `timeout`.
+    def region_checksum_request(self, addr, data_len, timeout=LG_SPECIAL_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        for i in range(0, 10):
+            data = self.lg_special_u32_data(DDC_50_CHECKSUM_CASE, addr, list(struct.pack(">H", data_len)), timeout)
+            if data[0] == 0x82:
+                return struct.unpack(">Q", bytes(data[1:9]))[0]
+            self.stats.count("region_checksum", "bad_status")
+            if time.monotonic() >= deadline:
+                self.stats.count("region_checksum", "timeouts")
+                raise DeviceTimeout("checksum at %08x not answered in %.1fs" % (addr, timeout))
+            timeout = deadline - time.monotonic()
+        return None
+
+    # Checksum of `data_len` bytes at `addr`, see region_checksum_data. Done
+    # on the monitor if the 0x75 patch is in, read back and summed here if not.
+    def region_checksum(self, addr, data_len):
+        total = 0
+        for i in range(0, data_len, DDC_50_CHECKSUM_MAX):
+            chunk_len = min(DDC_50_CHECKSUM_MAX, data_len - i)
+            chunk = None
+            if self.has_region_checksum:
+                chunk = self.region_checksum_request(addr+i, chunk_len)
+                if chunk is None:
+                    # Patch got lost (sleep?), do it the slow way
+                    self.stats.count("region_checksum", "fallbacks")
+                    self.has_region_checksum = False
+            if chunk is None:
+                chunk = region_checksum_data(self.lg_arbread_data(addr+i, chunk_len, use_cache=False))
+            total = region_checksum_combine(total, chunk, chunk_len)
+        return total
+
+    def lg_get_cur_monitor_sound(self):
+        return self.lg_arbread_u8(MONITOR_INFO_STRUCT+0x2b5)
+
+    def lg_set_cur_monitor_sound(self, val):
+        self.my_arbwrite_u8(MONITOR_INFO_STRUCT+0x2b5, val & 0xFF)
+
+    def lg_get_cur_primary(self):
+        return self.lg_arbread_u8(MONITOR_INFO_STRUCT+0x2d0)
+
+    def lg_get_cur_secondary(self):
+        return self.lg_arbread_u8(MONITOR_INFO_STRUCT+0x2d1)
+
+    def lg_set_cur_primary(self, val):
+        self.my_arbwrite_u8(MONITOR_INFO_STRUCT+0x2d0, val & 0xFF)
+
+    def lg_set_cur_secondary(self, val):
+        self.my_arbwrite_u8(MONITOR_INFO_STRUCT+0x2d1, val & 0xFF)
+
+    def lg_set_split(self, val):
+        if val > LG_SPLIT_FIX_AUDIO:
+            return False
+        if self.lg_get_split(use_cache=True) == val:
+            return True
+
+        ok = self.set_vcp(0xd7, val) != -1
+        # FIX_AUDIO isn't a layout, no telling what reads back after it
+        if ok and val != LG_SPLIT_FIX_AUDIO:
+            self.split_cache = (val, time.monotonic() + SHADOW_INFO_TTL)
+        else:
+            self.split_cache = None
+        return ok
+
+    # The OSD can change the split too, so the cache gets the same TTL as
+    # MONITOR_INFO_STRUCT
+    def lg_get_split(self, use_cache=False):
+        if use_cache and self.split_cache is not None and time.monotonic() < self.split_cache[1]:
+            return self.split_cache[0]
+
+        val = self.get_vcp(0xd7)
+        if val >= 0:
+            self.split_cache = (val, time.monotonic() + SHADOW_INFO_TTL)
+        return val
+
+    def lg_monitor_to_ddc(self, val):
+        my_lut = [MONITOR_HDMI1, MONITOR_HDMI2, MONITOR_DP1, MONITOR_USB_C, MONITOR_USB_C]
+        if val >= len(my_lut):
+            return 0
+        return my_lut[val]
+
+    def lg_set_primary_input(self, val):
+        self.lg_special(0xF4, self.lg_monitor_to_ddc(val))
+        self.shadow.invalidate(MONITOR_INFO_STRUCT+0x2d0, 2)
+
+    def lg_reset_monitor(self):
+        self.lg_special(0xF5, 0)
+        self.shadow.invalidate()
+
+        # Patches live in RAM, they're gone now
+        self.has_burst_read = False
+        self.has_burst_write = False
+        self.has_region_checksum = False
+
+DeviceCommand = collections.namedtuple("DeviceCommand", ["name", "fn", "args", "kwargs", "future", "priority", "targets"])
+
+#
+# The one thread allowed to touch the HID handle. Everything else (menu
+# clicks, the heartbeat, asyncio callers) queues a DeviceCommand and gets a
+# Future back, so two USB transactions can never interleave.
+#
+# Commands run by priority, then in the order they came in. A command with
+# `targets` (what it sets, e.g. ("vcp", 0xd7)) cancels anything still
+# queued whose targets it covers, so only the last of a burst of clicks
+# runs. Long commands call control.yield_point() between exchanges to let
+# anything more important that showed up in the meantime go first.
+#
+class DeviceWorker:
+
+    def __init__(self, control):
+        self.control = control
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+        self.stopping = False
+        self.running_priority = None
+        self.thread = None
+        control.worker = self
+
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="lg_hid", daemon=True)
+        self.thread.start()
+
+    # Finishes whatever's queued first
+    def stop(self):
+        if self.thread is None:
+            return
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+        self.thread = None
+
+    def submit(self, fn, *args, **kwargs):
+        return self.schedule(PRIORITY_NORMAL, None, fn, *args, **kwargs)
+
+    def schedule(self, priority, targets, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        targets = frozenset(targets) if targets else None
+        cmd = DeviceCommand(fn.__name__, fn, args, kwargs, future, priority, targets)
+        with self.cond:
+            if targets:
+                for item in self.heap:
+                    other = item[2]
+                    if other.targets and other.targets <= targets and other.future.cancel():
+                        self.control.stats.count("worker", "coalesced")
+            heapq.heappush(self.heap, (priority, next(self.seq), cmd))
+            self.cond.notify()
+        return future
+
+    # Blocking helper, don't call it from the worker itself
+    def call(self, fn, *args, **kwargs):
+        return self.submit(fn, *args, **kwargs).result()
+
+    # Next command to run, or None. With `below`, only one that outranks it
+    # and without waiting.
+    def next_command(self, below=None):
+        with self.cond:
+            while True:
+                while self.heap and self.heap[0][2].future.cancelled():
+                    heapq.heappop(self.heap)
+                if self.heap and (below is None or self.heap[0][0] < below):
+                    return heapq.heappop(self.heap)[2]
+                if below is not None or self.stopping:
+                    return None
+                self.cond.wait()
+
+    def execute(self, cmd):
+        if not cmd.future.set_running_or_notify_cancel():
+            return
+        outer = self.running_priority
+        self.running_priority = cmd.priority
+        try:
+            cmd.future.set_result(cmd.fn(*cmd.args, **cmd.kwargs))
+        except Exception as e:
+            print ("Device command", cmd.name, "failed:", e)
+            cmd.future.set_exception(e)
+        finally:
+            self.running_priority = outer
+
+    # Runs anything queued that outranks the command in progress, see
+    # LgUsbMonitorControl.yield_point()
+    def run_preempting(self):
+        if threading.current_thread() is not self.thread or self.running_priority is None:
+            return
+        while True:
+            cmd = self.next_command(below=self.running_priority)
+            if cmd is None:
+                return
+            self.control.stats.count("worker", "preemptions")
+            self.execute(cmd)
+
+    def run(self):
+        while True:
+            cmd = self.next_command()
+            if cmd is None:
+                break
+            self.execute(cmd)
@@ -0,0 +1,115 @@
+import subprocess
+import threading
+import time
+
+from lg_monitor.control import PRIORITY_BACKGROUND, DeviceDisconnected, DeviceTimeout
+from lg_monitor.patches import PATCH_SENTINEL_ADDR, run_patches
+
+# Heartbeats further apart than this mean the host (and likely the monitor)
+# was asleep
+HEARTBEAT_SLEEP_GAP = 30.0
+
+# How often (in seconds) the heartbeat checks the patch sentinel
+HEARTBEAT_INTERVAL = 4.0
+
+# Commands run when the heartbeat notices something (wake, repair,
+# disconnect/reconnect): (command, min seconds between runs, seconds after
+# which it runs anyway or None). They run in the background, and one still
+# going from last time just gets skipped.
+HEARTBEAT_HOOKS = [
+    ("fix_displays_and_mouse.sh", 4.0, 60.0),
+]
+
+#
+# Runs HEARTBEAT_HOOKS without waiting on them
+#
+class HookRunner:
+
+    def __init__(self, hooks):
+        self.hooks = hooks
+        self.lock = threading.Lock()
+        self.procs = dict()
+        self.last_run = dict()
+
+    # events: what happened, or None for the periodic runs
+    def run(self, events=None):
+        now = time.monotonic()
+        with self.lock:
+            for cmd, min_interval, period in self.hooks:
+                proc = self.procs.get(cmd)
+                if proc is not None and proc.poll() is None:
+                    continue
+
+                if not events and period is None:
+                    continue
+                last = self.last_run.get(cmd)
+                if last is not None:
+                    if events and now - last < min_interval:
+                        continue
+                    if not events and (period is None or now - last < period):
+                        continue
+
+                self.last_run[cmd] = now
+                try:
+                    self.procs[cmd] = subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL)
+                except OSError as e:
+                    print ("Couldn't run", cmd, e)
+
+#
+# One uncached read of the sentinel while everything's fine, the full
+# run_patches repair only if it's gone, the read failed or we just woke up.
+# Returns what happened, [] for nothing: "wake", "disconnected", "repaired"
+# or "repair_failed".
+#
+def heartbeat(control):
+    events = []
+
+    # Woke up from sleep, the monitor probably did too
+    now = time.monotonic()
+    if control.last_heartbeat is not None and now - control.last_heartbeat > HEARTBEAT_SLEEP_GAP:
+        control.shadow.invalidate()
+        events += ["wake"]
+    control.last_heartbeat = now
+
+    try:
+        sentinel = bytes(control.lg_arbread_data(PATCH_SENTINEL_ADDR, 2, use_cache=False))
+    except DeviceDisconnected:
+        # The reconnect puts the patches back itself
+        return ["disconnected"]
+    except DeviceTimeout:
+        # Most likely the patches are gone and 0xD1 with them
+        sentinel = None
+    if sentinel == b"\x55\xaa" and not events:
+        return events
+
+    #for i in range(0, 0x10):
+    #    print (hex(i), hex(device.lg_arbread_u32(0x005445d4+i*0x24)))
+    #print (hex(device.lg_arbread_u32(0x00544a5c)))
+
+    # Sometimes writes get dropped...
+    # The CC commands do not return *anything* so there's no way to know
+    # until the arbread patch goes through.
+    try:
+        for i in range(0, 10):
+            try:
+                if run_patches(control) == 0:
+                    return events + ["repaired"]
+            except DeviceTimeout:
+                # Counts as a failed pass, like startup()
+                pass
+    except DeviceDisconnected:
+        return events + ["disconnected"]
+    # Still not reading back right, the next heartbeat has another go
+    return events + ["repair_failed"]
+
+# Queues a heartbeat() on every session that isn't still busy with the last
+# one, then gives the periodic hooks their chance
+def heartbeat_all(sessions, hooks=None):
+    for session in sessions:
+        # Don't pile up heartbeats behind a slow one
+        if session.heartbeat_future is not None and not session.heartbeat_future.done():
+            continue
+        session.heartbeat_future = session.schedule(PRIORITY_BACKGROUND, None, heartbeat)
+        session.heartbeat_future.add_done_callback(session.heartbeat_done)
+    if hooks is not None:
+        hooks.run()
@@ -0,0 +1,1010 @@
+import hashlib
+import json
+import os
+import struct
+import time
+
+from lg_monitor.control import (
+    DeviceTimeout, DDC_50_CHECKSUM_CASE, DDC_50_CHECKSUM_MAX, DDC_50_D1_1, DDC_50_D1_BURST,
+    DDC_50_D1_CHECKSUM, DDC_50_D5_1, DDC_50_D5_BURST, DDC_50_DEFAULT_CASE,
+    DDC_50_SWITCHTABLE, SHADOW_CODE_TTL, VCP_D7_GET_1, VCP_D7_SET_1, VCP_D7_SET_2,
+    VCP_D7_SET_3, VCP_D7_SET_4, VCP_D7_SET_5,
+    merge_ranges, read_spans, region_checksum_data,
+)
+
+#
+# Patch manifest
+#
+# Every patch we put down, as data:
+#   name:      what run_patches and friends refer to it by
+#   firmware:  (model, scalar version) pairs it was written against
+#   requires:  patches that have to be in place first
+#   bootstrap: goes in before anything else and is checked on its own, so
+#              it's left out of the heartbeat diff
+#   atomic:    False if it has to go in with the non-atomic 0xCC arbwrite,
+#              because the atomic one isn't there yet
+#   writes:    (addr, bytes)
+#   verify:    (addr, len) ranges that show whether it's in, defaults to
+#              the written ranges
+#   cave_case: for anything written over LG's own 0x50 handlers, the case
+#              that's meant to land on it (None for data). Every other case
+#              pointing into these ranges gets sent to the default case
+#              before they're written, see PatchPlanner.stray_cases().
+#
+# compile_patch_manifest() turns it into a flat plan, cached on disk by
+# content hash, which is all PatchPlanner ever looks at.
+#
+def be16(val):
+    return list(struct.pack(">H", val))
+
+def be24(val):
+    return list(struct.pack(">L", val))[1:]
+
+def be32(val):
+    return list(struct.pack(">L", val))
+
+def le32(val):
+    return list(struct.pack("<L", val))
+
+def switchtable_case(idx):
+    return DDC_50_SWITCHTABLE+((idx-0x10)*4)
+
+# (model, scalar version) as returned by LG specials 0xCA and 0xC9
+FIRMWARE_28MQ780_V330 = ("28MQ780", "820330")
+SUPPORTED_FIRMWARE = [FIRMWARE_28MQ780_V330]
+
+# Bump when compile_patch_manifest changes what it spits out
+PATCH_PLAN_VERSION = 2
+PATCH_PLAN_CACHE_DIR = os.path.expanduser("~/.cache/lg_display_manager")
+
+# What the last successful startup left behind, see warm_start()
+SESSION_PATH = os.path.join(PATCH_PLAN_CACHE_DIR, "session.json")
+
+# Each monitor picked by path/serial gets its own session file next to
+# SESSION_PATH, keyed by serial (stable across replugs) or else by HID path
+def session_path(control):
+    if not SESSION_PATH or (control.serial is None and control.path is None):
+        return SESSION_PATH
+
+    key = control.serial or control.path
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    return os.path.join(os.path.dirname(SESSION_PATH), "session_%s.json" % hashlib.sha256(key).hexdigest()[:16])
+
+# Written by us once the 0xD5 atomic write works, gone after a reset/sleep
+PATCH_SENTINEL_ADDR = DDC_50_D5_1+41
+
+PATCH_MANIFEST = [
+    #
+    # Patch DDC2AB (0x50) 0xD1 to be an atomic u8 read
+    # This is required to prevent random crashes when reading/writing, if the
+    # LG arbwrite pointer randomly changes or is reset to 0 due to sleep.
+    #
+    {
+        "name": "atomic_read",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": [],
+        "bootstrap": True,
+        "atomic": False,
+        "cave_case": 0xd1,
+        "writes": [
+            (DDC_50_D1_1+0,  be24(0x106a04)), # bn.lbz    r3,0x4(r10)
+            (DDC_50_D1_1+3,  be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D1_1+6,  be24(0x108a05)), # bn.lbz    r4,0x5(r10)
+            (DDC_50_D1_1+9,  be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D1_1+12, be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D1_1+15, be24(0x108a06)), # bn.lbz    r4,0x6(r10)
+            (DDC_50_D1_1+18, be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D1_1+21, be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D1_1+24, be24(0x108a07)), # bn.lbz    r4,0x7(r10)
+            (DDC_50_D1_1+27, be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D1_1+30, be24(0x106300)), # bn.lbz    r3,0(r3)
+            (DDC_50_D1_1+33, be24(0x187201)), # bn.sbz    0x1(r18),r3
+            (DDC_50_D1_1+36, be24(0x506082)), # bn.ori    r3,r0,0x82
+            (DDC_50_D1_1+39, be24(0x2FFB0E)), # bn.j      LAB_0029777a
+        ],
+        # Unpatched 0xD1 answers too, with garbage, so the first instruction
+        # reading back is as good as it gets
+        "verify": [(DDC_50_D1_1, 2)],
+    },
+
+    #
+    # Patch DDC2AB (0x50) 0xD5 to be an atomic u8 write
+    # This is required to prevent random crashes when reading/writing, if the
+    # LG arbwrite pointer randomly changes or is reset to 0 due to sleep.
+    #
+    {
+        "name": "atomic_write",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_read"],
+        "bootstrap": True,
+        "atomic": False,
+        "cave_case": 0xd5,
+        "writes": [
+            (DDC_50_D5_1+0,  be24(0x106a04)), # bn.lbz    r3,0x4(r10)
+            (DDC_50_D5_1+3,  be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D5_1+6,  be24(0x108a05)), # bn.lbz    r4,0x5(r10)
+            (DDC_50_D5_1+9,  be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D5_1+12, be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D5_1+15, be24(0x108a06)), # bn.lbz    r4,0x6(r10)
+            (DDC_50_D5_1+18, be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D5_1+21, be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D5_1+24, be24(0x108a07)), # bn.lbz    r4,0x7(r10)
+            (DDC_50_D5_1+27, be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D5_1+30, be24(0x108a08)), # bn.lbz    r4,0x8(r10)
+            (DDC_50_D5_1+33, be24(0x188300)), # bn.sbz    0(r3),r4
+            (DDC_50_D5_1+36, be24(0x506082)), # bn.ori    r3,r0,0x82
+            (DDC_50_D5_1+39, be16(0x935a)), # bn.j      LAB_0029777a
+        ],
+        # Only the sentinel tells us 0xD5 runs
+        "verify": [(PATCH_SENTINEL_ADDR, 2)],
+    },
+
+    # Goes in through 0xD5 itself, so it only reads back if that works
+    {
+        "name": "sentinel",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_write"],
+        "bootstrap": True,
+        # Right behind the 0xD5 code, nothing may jump here either
+        "cave_case": None,
+        "writes": [
+            (PATCH_SENTINEL_ADDR, be16(0x55aa)),
+        ],
+    },
+
+    #
+    # DDC2AB (0x50) 0xD6 is an atomic burst read, which returns up to
+    # DDC_50_BURST_MAX_READ bytes per request instead of one.
+    #
+    {
+        "name": "atomic_read_burst",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_read", "atomic_write"],
+        "cave_case": 0xd6,
+        # Same request layout as 0xD5, byte 8 is the number of bytes to read
+        "writes": [
+            (DDC_50_D1_BURST+0,  be24(0x106a04)), # bn.lbz    r3,0x4(r10)
+            (DDC_50_D1_BURST+3,  be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D1_BURST+6,  be24(0x108a05)), # bn.lbz    r4,0x5(r10)
+            (DDC_50_D1_BURST+9,  be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D1_BURST+12, be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D1_BURST+15, be24(0x108a06)), # bn.lbz    r4,0x6(r10)
+            (DDC_50_D1_BURST+18, be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D1_BURST+21, be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D1_BURST+24, be24(0x108a07)), # bn.lbz    r4,0x7(r10)
+            (DDC_50_D1_BURST+27, be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D1_BURST+30, be24(0x1cb201)), # bn.addi   r5,r18,0x1
+            # LAB_00297c90
+            (DDC_50_D1_BURST+33, be24(0x108a08)), # bn.lbz    r4,0x8(r10)
+            (DDC_50_D1_BURST+36, be32(0xd08000ca)), # bg.beqi   r4,0x0,LAB_00297cac
+            (DDC_50_D1_BURST+40, be24(0x1c84ff)), # bn.addi   r4,r4,-0x1
+            (DDC_50_D1_BURST+43, be24(0x188a08)), # bn.sbz    0x8(r10),r4
+            (DDC_50_D1_BURST+46, be24(0x108300)), # bn.lbz    r4,0x0(r3)
+            (DDC_50_D1_BURST+49, be24(0x188500)), # bn.sbz    0x0(r5),r4
+            (DDC_50_D1_BURST+52, be24(0x1c6301)), # bn.addi   r3,r3,0x1
+            (DDC_50_D1_BURST+55, be24(0x1ca501)), # bn.addi   r5,r5,0x1
+            (DDC_50_D1_BURST+58, be24(0x2fffe7)), # bn.j      LAB_00297c90
+            # LAB_00297cac
+            (DDC_50_D1_BURST+61, be24(0x506082)), # bn.ori    r3,r0,0x82
+            (DDC_50_D1_BURST+64, be24(0x2ffacb)), # bn.j      LAB_0029777a
+        ],
+    },
+
+    #
+    # DDC2AB (0x50) 0xD7 is an atomic burst write, which carries up to
+    # DDC_50_BURST_MAX_WRITE bytes per request instead of one.
+    #
+    {
+        "name": "atomic_write_burst",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_read", "atomic_write"],
+        "cave_case": 0xd7,
+        # Byte 8 is the number of bytes, the payload follows from byte 9
+        "writes": [
+            (DDC_50_D5_BURST+0,  be24(0x106a04)), # bn.lbz    r3,0x4(r10)
+            (DDC_50_D5_BURST+3,  be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D5_BURST+6,  be24(0x108a05)), # bn.lbz    r4,0x5(r10)
+            (DDC_50_D5_BURST+9,  be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D5_BURST+12, be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D5_BURST+15, be24(0x108a06)), # bn.lbz    r4,0x6(r10)
+            (DDC_50_D5_BURST+18, be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D5_BURST+21, be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D5_BURST+24, be24(0x108a07)), # bn.lbz    r4,0x7(r10)
+            (DDC_50_D5_BURST+27, be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D5_BURST+30, be24(0x1caa09)), # bn.addi   r5,r10,0x9
+            # LAB_00297845
+            (DDC_50_D5_BURST+33, be24(0x108a08)), # bn.lbz    r4,0x8(r10)
+            (DDC_50_D5_BURST+36, be32(0xd08000ca)), # bg.beqi   r4,0x0,LAB_00297861
+            (DDC_50_D5_BURST+40, be24(0x1c84ff)), # bn.addi   r4,r4,-0x1
+            (DDC_50_D5_BURST+43, be24(0x188a08)), # bn.sbz    0x8(r10),r4
+            (DDC_50_D5_BURST+46, be24(0x108500)), # bn.lbz    r4,0x0(r5)
+            (DDC_50_D5_BURST+49, be24(0x188300)), # bn.sbz    0x0(r3),r4
+            (DDC_50_D5_BURST+52, be24(0x1c6301)), # bn.addi   r3,r3,0x1
+            (DDC_50_D5_BURST+55, be24(0x1ca501)), # bn.addi   r5,r5,0x1
+            (DDC_50_D5_BURST+58, be24(0x2fffe7)), # bn.j      LAB_00297845
+            # LAB_00297861
+            (DDC_50_D5_BURST+61, be24(0x506082)), # bn.ori    r3,r0,0x82
+            (DDC_50_D5_BURST+64, be24(0x2fff16)), # bn.j      LAB_0029777a
+        ],
+    },
+
+    #
+    # DDC2AB (0x50) 0x75 sums up to DDC_50_CHECKSUM_MAX bytes on the monitor
+    # (see region_checksum_data) and sends back a and b, so verifying a range
+    # is one exchange no matter how big it is.
+    # Like the burst loops, but the length is a u16 at bytes 8/9 and it needs
+    # r6/r7 on top of r3-r5.
+    #
+    {
+        "name": "region_checksum",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_read", "atomic_write"],
+        "cave_case": DDC_50_CHECKSUM_CASE,
+        "writes": [
+            (DDC_50_D1_CHECKSUM+0,   be24(0x106a04)), # bn.lbz    r3,0x4(r10)
+            (DDC_50_D1_CHECKSUM+3,   be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D1_CHECKSUM+6,   be24(0x108a05)), # bn.lbz    r4,0x5(r10)
+            (DDC_50_D1_CHECKSUM+9,   be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D1_CHECKSUM+12,  be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D1_CHECKSUM+15,  be24(0x108a06)), # bn.lbz    r4,0x6(r10)
+            (DDC_50_D1_CHECKSUM+18,  be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D1_CHECKSUM+21,  be24(0x4c6340)), # bn.slli   r3,r3,8
+            (DDC_50_D1_CHECKSUM+24,  be24(0x108a07)), # bn.lbz    r4,0x7(r10)
+            (DDC_50_D1_CHECKSUM+27,  be24(0x446325)), # bn.or     r3,r3,r4
+            (DDC_50_D1_CHECKSUM+30,  be24(0x108a08)), # bn.lbz    r4,0x8(r10)
+            (DDC_50_D1_CHECKSUM+33,  be24(0x4c8440)), # bn.slli   r4,r4,8
+            (DDC_50_D1_CHECKSUM+36,  be24(0x10aa09)), # bn.lbz    r5,0x9(r10)
+            (DDC_50_D1_CHECKSUM+39,  be24(0x44842d)), # bn.or     r4,r4,r5
+            (DDC_50_D1_CHECKSUM+42,  be24(0x50a000)), # bn.ori    r5,r0,0x0
+            (DDC_50_D1_CHECKSUM+45,  be24(0x50c000)), # bn.ori    r6,r0,0x0
+            # LAB_00297ce2
+            (DDC_50_D1_CHECKSUM+48,  be32(0xd08000b2)), # bg.beqi   r4,0x0,LAB_00297cf8
+            (DDC_50_D1_CHECKSUM+52,  be24(0x1c84ff)), # bn.addi   r4,r4,-0x1
+            (DDC_50_D1_CHECKSUM+55,  be24(0x10e300)), # bn.lbz    r7,0x0(r3)
+            (DDC_50_D1_CHECKSUM+58,  be24(0x44a538)), # bn.add    r5,r5,r7
+            (DDC_50_D1_CHECKSUM+61,  be24(0x44c628)), # bn.add    r6,r6,r5
+            (DDC_50_D1_CHECKSUM+64,  be24(0x1c6301)), # bn.addi   r3,r3,0x1
+            (DDC_50_D1_CHECKSUM+67,  be24(0x2fffed)), # bn.j      LAB_00297ce2
+            # LAB_00297cf8
+            (DDC_50_D1_CHECKSUM+70,  be24(0x18b204)), # bn.sbz    0x4(r18),r5
+            (DDC_50_D1_CHECKSUM+73,  be24(0x4ca541)), # bn.srli   r5,r5,8
+            (DDC_50_D1_CHECKSUM+76,  be24(0x18b203)), # bn.sbz    0x3(r18),r5
+            (DDC_50_D1_CHECKSUM+79,  be24(0x4ca541)), # bn.srli   r5,r5,8
+            (DDC_50_D1_CHECKSUM+82,  be24(0x18b202)), # bn.sbz    0x2(r18),r5
+            (DDC_50_D1_CHECKSUM+85,  be24(0x4ca541)), # bn.srli   r5,r5,8
+            (DDC_50_D1_CHECKSUM+88,  be24(0x18b201)), # bn.sbz    0x1(r18),r5
+            (DDC_50_D1_CHECKSUM+91,  be24(0x18d208)), # bn.sbz    0x8(r18),r6
+            (DDC_50_D1_CHECKSUM+94,  be24(0x4cc641)), # bn.srli   r6,r6,8
+            (DDC_50_D1_CHECKSUM+97,  be24(0x18d207)), # bn.sbz    0x7(r18),r6
+            (DDC_50_D1_CHECKSUM+100, be24(0x4cc641)), # bn.srli   r6,r6,8
+            (DDC_50_D1_CHECKSUM+103, be24(0x18d206)), # bn.sbz    0x6(r18),r6
+            (DDC_50_D1_CHECKSUM+106, be24(0x4cc641)), # bn.srli   r6,r6,8
+            (DDC_50_D1_CHECKSUM+109, be24(0x18d205)), # bn.sbz    0x5(r18),r6
+            (DDC_50_D1_CHECKSUM+112, be24(0x506082)), # bn.ori    r3,r0,0x82
+            (DDC_50_D1_CHECKSUM+115, be24(0x2ffa55)), # bn.j      LAB_0029777a
+        ],
+    },
+
+    # These got clobbered by the patches.
+    {
+        "name": "clobbered_cases",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_write"],
+        "writes": [
+            (switchtable_case(0x68), le32(DDC_50_DEFAULT_CASE)),
+            (switchtable_case(0x69), le32(DDC_50_DEFAULT_CASE)),
+        ],
+    },
+
+    # 0x75/0xD6/0xD7 were clobbered too, they're our checksum and burst
+    # read/write now
+    {
+        "name": "burst_read_case",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_read_burst"],
+        "writes": [
+            (switchtable_case(0xd6), le32(DDC_50_D1_BURST)),
+        ],
+    },
+    {
+        "name": "burst_write_case",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_write_burst"],
+        "writes": [
+            (switchtable_case(0xd7), le32(DDC_50_D5_BURST)),
+        ],
+    },
+    {
+        "name": "region_checksum_case",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["region_checksum"],
+        "writes": [
+            (switchtable_case(DDC_50_CHECKSUM_CASE), le32(DDC_50_D1_CHECKSUM)),
+        ],
+    },
+
+    #
+    # Patch VCP 0xD7 setter/getter to just send raw split values
+    #
+    {
+        "name": "d7_pbp_pip",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_write"],
+        "writes": [
+            # We keep the 0x0 extra bits, but make it the same as 0x1 was before
+            (VCP_D7_SET_1+0, be32(0xd140326a)), # bg.beqi    r10,0x0,LAB_002ee2ae
+
+            # We make 0xe apply sound swaps
+            (VCP_D7_SET_1+4, be32(0xd14e3332)), # bg.beqi    r10,0xe,LAB_002ee2cb
+
+            # And everything else is just directly raw
+            (VCP_D7_SET_1+8, be32(0xe4000cfb)), # bg.j LAB_002ee2e6
+            (VCP_D7_SET_2+0, be16(0x8001)), # bt.nop
+            (VCP_D7_SET_2+2, be16(0x8001)), # bt.nop
+            (VCP_D7_SET_2+4, be16(0x8001)), # bt.nop
+
+            # Use the raw value
+            (VCP_D7_SET_3+0, be16(0x886a)), # bt.mov r3,r10
+
+            # 0xE sound swap stuff
+            (VCP_D7_SET_4+0,  be32(0xe7f7ec0e)), # bg.jal     get_which_monitor_has_sound
+            (VCP_D7_SET_4+4,  be32(0xe7f826f4)), # bg.jal     sets_which_monitor_has_sound
+            (VCP_D7_SET_4+8,  be16(0x8001)), # bt.nop
+            (VCP_D7_SET_4+10, be16(0x8001)), # bt.nop
+            (VCP_D7_SET_4+12, be16(0x8001)), # bt.nop
+            (VCP_D7_SET_4+14, be16(0x8001)), # bt.nop
+            (VCP_D7_SET_4+16, be16(0x8001)), # bt.nop
+            (VCP_D7_SET_4+18, be16(0x8001)), # bt.nop
+            (VCP_D7_SET_4+20, be16(0x8001)), # bt.nop
+            (VCP_D7_SET_4+22, be16(0x8001)), # bt.nop
+
+            # Make 0x0 the same as 0x1 was before
+            (VCP_D7_SET_5+0,  be16(0x9860)), # bt.movi r3,0
+
+            # Getter
+            (VCP_D7_GET_1+0,  be16(0x8001)), # bt.nop
+            (VCP_D7_GET_1+2,  be16(0x8001)), # bt.nop
+            (VCP_D7_GET_1+12, be16(0x8883)), # bt.mov r4,r3
+        ],
+    },
+
+    # Unlock all of the PIP/PBP menu options that are useful (not the vertical 3-ways)
+    {
+        "name": "menu_unlocks",
+        "firmware": [FIRMWARE_28MQ780_V330],
+        "requires": ["atomic_write"],
+        "writes": [
+            (0x002951dc, be24(0x1c6000 | (0x3 & 0xFF))), # ori r3,r0,val
+            (0x00295c02, be24(0x1c6000 | (0x0 & 0xFF))), # ori r3,r0,val
+            (0x00295c28, be24(0x1c6000 | (0x0 & 0xFF))), # ori r3,r0,val
+
+            # disp overclock?
+            #(0x002957a5, be24(0x1c6000 | (0x0 & 0xFF))), # ori r3,r0,val
+            #(0x002957d3, be24(0x1c6000 | (0x0 & 0xFF))), # ori r3,r0,val
+
+            # Choose different tool menus
+            #(0x002d2487, be24(0x1c8000 | (0x8 & 0xFF))),
+
+            # Override PBP menu to any other menu
+            #(0x002b9155, [0xa9]),
+
+            #(0x002bc283, be16(0x98eb)),
+        ],
+    },
+]
+
+def modify_50_switchtable_case(control, idx, val):
+    if idx < 0x10:
+        return
+    control.my_arbwrite_u32(switchtable_case(idx), val)
+
+# Content hash of the manifest plus everything else that goes into a plan
+def patch_manifest_digest(manifest, firmware):
+    canon = []
+    for entry in manifest:
+        canon += [{
+            "name": entry["name"],
+            "firmware": [list(fw) for fw in entry["firmware"]],
+            "requires": list(entry.get("requires", [])),
+            "bootstrap": entry.get("bootstrap", False),
+            "atomic": entry.get("atomic", True),
+            "writes": [[addr, bytes(val).hex()] for addr, val in entry["writes"]],
+            "verify": [list(v) for v in entry.get("verify", [])],
+            "cave_case": entry.get("cave_case", -1),
+        }]
+    blob = json.dumps({"version": PATCH_PLAN_VERSION, "firmware": list(firmware), "manifest": canon}, sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+#
+# Flattens the manifest for one firmware into steps in dependency order.
+# Each step only keeps the bytes it's the last one to write, merged into
+# sorted runs, and `spans` is what a heartbeat reads back to verify every
+# non-bootstrap step at once.
+#
+def compile_patch_manifest(manifest, firmware):
+    by_name = dict()
+    for entry in manifest:
+        if entry["name"] in by_name:
+            raise ValueError("Duplicate patch " + entry["name"])
+        if tuple(firmware) in [tuple(fw) for fw in entry["firmware"]]:
+            by_name[entry["name"]] = entry
+
+    order = []
+    visiting = set()
+    def visit(name, why):
+        if name in order:
+            return
+        if name not in by_name:
+            raise ValueError("Patch " + why + " needs " + name + ", which isn't there for " + repr(firmware))
+        if name in visiting:
+            raise ValueError("Patch dependency loop at " + name)
+        visiting.add(name)
+        for dep in by_name[name].get("requires", []):
+            visit(dep, name)
+        visiting.remove(name)
+        order.append(name)
+    for entry in manifest:
+        if entry["name"] in by_name:
+            visit(entry["name"], entry["name"])
+
+    # Later steps win
+    owner = dict()
+    image = dict()
+    for name in order:
+        for addr, val in by_name[name]["writes"]:
+            for i in range(0, len(val)):
+                owner[addr+i] = name
+                image[addr+i] = val[i]
+
+    # Everything that goes over LG's 0x50 handlers, and where each case of
+    # ours is supposed to land in it
+    caves = []
+    cave_entries = []
+    for name in order:
+        entry = by_name[name]
+        if "cave_case" not in entry:
+            continue
+        caves += [(addr, val) for addr, val in entry["writes"]]
+        if entry["cave_case"] is not None:
+            cave_entries += [[entry["cave_case"], min([addr for addr, val in entry["writes"]])]]
+
+    steps = []
+    verify = []
+    for name in order:
+        entry = by_name[name]
+        ranges = merge_ranges([(addr+i, [image[addr+i]]) for addr, val in entry["writes"] for i in range(0, len(val)) if owner[addr+i] == name])
+        step_verify = entry.get("verify", [(addr, len(val)) for addr, val in ranges])
+        steps += [{
+            "name": name,
+            "bootstrap": entry.get("bootstrap", False),
+            "atomic": entry.get("atomic", True),
+            "ranges": [[addr, bytes(val).hex()] for addr, val in ranges],
+            "verify": [[addr, data_len] for addr, data_len in step_verify],
+        }]
+        if not entry.get("bootstrap", False):
+            verify += [(addr, [image.get(addr+i, 0) for i in range(0, data_len)]) for addr, data_len in step_verify]
+
+    return {
+        "version": PATCH_PLAN_VERSION,
+        "digest": patch_manifest_digest(manifest, firmware),
+        "firmware": list(firmware),
+        "steps": steps,
+        "spans": [[addr, data_len] for addr, data_len in read_spans(merge_ranges(verify))],
+        "image": [[addr, bytes(val).hex()] for addr, val in merge_ranges([(addr, [image[addr]]) for addr in image])],
+        "caves": [[addr, len(val)] for addr, val in merge_ranges(caves)],
+        "cave_entries": cave_entries,
+    }
+
+# Returns the compiled plan for `firmware`, from the on-disk cache if the
+# manifest hasn't changed since it was last compiled
+def load_patch_plan(firmware=FIRMWARE_28MQ780_V330, manifest=None, cache_dir=None):
+    if manifest is None:
+        manifest = PATCH_MANIFEST
+    if cache_dir is None:
+        cache_dir = PATCH_PLAN_CACHE_DIR
+
+    digest = patch_manifest_digest(manifest, firmware)
+    fpath = None
+    if cache_dir:
+        fpath = os.path.join(cache_dir, "patch_plan_" + digest + ".json")
+        try:
+            with open(fpath) as f:
+                plan = json.load(f)
+            if plan.get("digest") == digest:
+                return plan
+        except (OSError, ValueError):
+            pass
+
+    plan = compile_patch_manifest(manifest, firmware)
+
+    if fpath is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(fpath + ".tmp", "w") as f:
+                json.dump(plan, f, sort_keys=True)
+            os.replace(fpath + ".tmp", fpath)
+        except OSError as e:
+            print ("Couldn't cache patch plan", e)
+    return plan
+
+#
+# Holds the expected bytes of everything run_patches pokes, so a heartbeat
+# only has to read the ranges back and rewrite whatever doesn't match.
+#
+class PatchPlanner:
+
+    def __init__(self, plan, control):
+        self.plan = plan
+        self.control = control
+        self.firmware = tuple(plan["firmware"])
+        self.spans = [(addr, data_len) for addr, data_len in plan["spans"]]
+
+        self.steps = dict()
+        for step in plan["steps"]:
+            self.steps[step["name"]] = step
+
+        self.expected = dict()
+        for addr, val in plan["image"]:
+            for i, b in enumerate(bytes.fromhex(val)):
+                self.expected[addr+i] = b
+
+        # What the spans read back as last time, if nothing got written since
+        self.last_read = None
+
+        # (addr, len, checksum) for each checksum_groups() range, from when
+        # everything last read back right
+        self.checksums = None
+
+        self.caves = [(addr, data_len) for addr, data_len in plan["caves"]]
+        self.cave_entries = dict()
+        for idx, addr in plan["cave_entries"]:
+            self.cave_entries[idx] = addr
+
+        # 0x50 cases that land in the caves without being ours, None until
+        # the switch table got read (or the cache did)
+        self.strays = None
+        self.strays_redirected = False
+
+    # Writes one step as is
+    def write_step(self, name):
+        step = self.steps[name]
+        with self.control.write_batch():
+            for addr, val in step["ranges"]:
+                if step["atomic"]:
+                    self.control.my_arbwrite(addr, list(bytes.fromhex(val)))
+                else:
+                    self.control.lg_arbwrite(addr, list(bytes.fromhex(val)))
+
+    # The 0x50 cases other than our own that point somewhere into the caves,
+    # as the switch table is right now
+    def find_stray_cases(self):
+        table = bytes(self.control.lg_arbread_data(switchtable_case(0x10), (0x100-0x10)*4, use_cache=False))
+        strays = []
+        for idx in range(0x10, 0x100):
+            target = struct.unpack_from("<L", table, (idx-0x10)*4)[0]
+            if self.cave_entries.get(idx) == target:
+                continue
+            for addr, data_len in self.caves:
+                if addr <= target < addr + data_len:
+                    strays += [idx]
+                    break
+        return strays
+
+    # find_stray_cases(), cached per plan. Only a stock table (fresh) gets
+    # cached, once they're pointed elsewhere they don't show up anymore.
+    def stray_cases(self, fresh):
+        if self.strays is not None:
+            return self.strays
+
+        fpath = None
+        if PATCH_PLAN_CACHE_DIR:
+            fpath = os.path.join(PATCH_PLAN_CACHE_DIR, "stray_cases_" + self.plan["digest"] + ".json")
+            try:
+                with open(fpath) as f:
+                    self.strays = json.load(f)["strays"]
+                return self.strays
+            except (OSError, ValueError, KeyError):
+                pass
+
+        strays = self.find_stray_cases()
+        if not fresh:
+            return strays
+        self.strays = strays
+
+        if fpath is not None:
+            try:
+                os.makedirs(PATCH_PLAN_CACHE_DIR, exist_ok=True)
+                with open(fpath + ".tmp", "w") as f:
+                    json.dump({"digest": self.plan["digest"], "strays": strays}, f)
+                os.replace(fpath + ".tmp", fpath)
+            except OSError as e:
+                print ("Couldn't cache stray cases", e)
+        return strays
+
+    # Writes a step until all of it reads back, for code a switch-table case
+    # is about to be pointed at. force: write it even if it already does.
+    def put_step(self, name, force=False):
+        if force:
+            self.write_step(name)
+        while not self.step_ok(name):
+            self.write_step(name)
+
+    # Whether a step's verify ranges read back as planned, a read that timed
+    # out counts as not
+    def step_ok(self, name):
+        for addr, data_len in self.steps[name]["verify"]:
+            try:
+                data = self.control.lg_arbread_data(addr, data_len, use_cache=False)
+            except DeviceTimeout:
+                return False
+            for i in range(0, data_len):
+                if addr+i in self.expected and data[i] != self.expected[addr+i]:
+                    return False
+        return True
+
+    # Returns the (addr, bytes) runs that don't match the device, in the
+    # order the steps need them written
+    def diff(self):
+        wrong = set()
+        self.last_read = []
+        for addr, data_len in self.spans:
+            data = self.control.lg_arbread_data(addr, data_len, use_cache=False)
+            self.last_read += [bytes(data)]
+            for i in range(0, data_len):
+                if addr+i in self.expected and data[i] != self.expected[addr+i]:
+                    wrong.add(addr+i)
+
+        diffs = []
+        for step in self.plan["steps"]:
+            if step["bootstrap"]:
+                continue
+            for addr, val in step["ranges"]:
+                val = bytes.fromhex(val)
+                for i in range(0, len(val)):
+                    if addr+i not in wrong:
+                        continue
+                    if diffs and diffs[-1][0] + len(diffs[-1][1]) == addr+i:
+                        diffs[-1][1].append(val[i])
+                    else:
+                        diffs += [(addr+i, [val[i]])]
+        return diffs
+
+    # The spans, grouped into ranges the 0x75 patch can sum up in one go. What
+    # ends up in between is LG's code, which doesn't change under us.
+    def checksum_groups(self):
+        groups = []
+        for addr, data_len in self.spans:
+            if groups and addr + data_len - groups[-1][0] <= DDC_50_CHECKSUM_MAX:
+                groups[-1] = (groups[-1][0], addr + data_len - groups[-1][0])
+            else:
+                groups += [(addr, data_len)]
+        return groups
+
+    # Only call this right after everything read back fine
+    def record_checksums(self):
+        self.checksums = None
+        if not self.control.has_region_checksum:
+            return
+
+        checksums = []
+        for addr, data_len in self.checksum_groups():
+            val = self.control.region_checksum_request(addr, data_len)
+            if val is None:
+                self.control.has_region_checksum = False
+                return
+            checksums += [(addr, data_len, val)]
+        self.checksums = checksums
+
+    # A few exchanges instead of reading every span back, False means "don't
+    # know", not "broken"
+    def checksums_ok(self):
+        if self.checksums is None or not self.control.has_region_checksum:
+            return False
+
+        for addr, data_len, val in self.checksums:
+            cur = self.control.region_checksum_request(addr, data_len)
+            if cur is None:
+                self.control.has_region_checksum = False
+                return False
+            if cur != val:
+                return False
+        return True
+
+    # Returns how many runs had to be rewritten
+    def apply(self):
+        had_checksums = self.checksums is not None and self.control.has_region_checksum
+        if self.checksums_ok():
+            return 0
+
+        diffs = self.diff()
+        if diffs:
+            self.last_read = None
+            self.checksums = None
+        elif had_checksums and self.control.has_region_checksum:
+            # Everything's in, so the sums we had are what's out of date
+            self.record_checksums()
+        with self.control.write_batch():
+            for addr, val in diffs:
+                self.control.my_arbwrite(addr, val)
+        return len(diffs)
+
+def load_patch_planner(control):
+    firmware = control.firmware
+    if firmware is None:
+        firmware = SUPPORTED_FIRMWARE[0]
+    if control.patch_planner is None or control.patch_planner.firmware != tuple(firmware):
+        control.patch_planner = PatchPlanner(load_patch_plan(firmware), control)
+    for addr, data_len in control.patch_planner.spans:
+        if control.shadow.ttl_for(addr) is None:
+            control.shadow.add_range(addr, data_len, SHADOW_CODE_TTL)
+    return control.patch_planner
+
+# Returns how many patched ranges were missing, 0 means everything read back
+# fine and nothing was written. Nothing else gets to run on the worker until
+# it's done, a half patched monitor isn't one to poke at.
+def run_patches(control):
+    # Put them back after a reconnect too
+    control.repair = run_patches
+    with control.critical():
+        return patch_monitor(control)
+
+def patch_monitor(control):
+    planner = load_patch_planner(control)
+
+    fresh = False
+    if control.lg_arbread_u16_be(PATCH_SENTINEL_ADDR) != 0x55aa:
+        # Monitor got reset or slept, nothing we patched can be trusted
+        fresh = True
+        control.has_burst_read = False
+        control.has_burst_write = False
+        control.has_region_checksum = False
+        planner.checksums = None
+        control.shadow.invalidate()
+
+        # Sometimes writes get dropped, and the CC commands don't return
+        # *anything*, so keep at it until they read back
+        while not planner.step_ok("atomic_read"):
+            for i in range(0, 2):
+                planner.write_step("atomic_read")
+
+        while not planner.step_ok("atomic_write"):
+            for i in range(0, 2):
+                planner.write_step("atomic_write")
+
+            planner.write_step("sentinel")
+
+    #
+    # The burst and checksum code goes over more of LG's 0x50 handlers than
+    # the u8 patches and the sentinel, and only the cases we knew about got
+    # pointed away from them. Send every other case that lands anywhere in
+    # the caves to the default case before any of it gets written.
+    #
+    if fresh or not planner.strays_redirected:
+        for idx in planner.stray_cases(fresh):
+            modify_50_switchtable_case(control, idx, DDC_50_DEFAULT_CASE)
+        planner.strays_redirected = True
+
+    #
+    # DDC2AB (0x50) 0xD7 is an atomic burst write, which carries up to
+    # DDC_50_BURST_MAX_WRITE bytes per request instead of one. It goes in
+    # first so everything after doesn't have to be written a byte at a time.
+    # The case only gets pointed at it once all of it reads back. Flip the
+    # sentinel through it and back to make sure the whole loop runs,
+    # unpatched cases still answer with 0x82.
+    #
+    if not control.has_burst_write:
+        planner.put_step("atomic_write_burst", fresh)
+        if fresh or not planner.step_ok("burst_write_case"):
+            planner.write_step("burst_write_case")
+        if control.my_arbwrite_burst(PATCH_SENTINEL_ADDR, [0xaa, 0x55]) and control.lg_arbread_u16_be(PATCH_SENTINEL_ADDR) == 0xaa55:
+            control.has_burst_write = control.my_arbwrite_burst(PATCH_SENTINEL_ADDR, [0x55, 0xaa])
+
+    #
+    # DDC2AB (0x50) 0xD6 is an atomic burst read, which returns up to
+    # DDC_50_BURST_MAX_READ bytes per request instead of one. Same deal,
+    # make sure the whole loop actually runs before trusting it. 0xD6 only
+    # gets pointed at it once every byte of it reads back.
+    #
+    if not control.has_burst_read:
+        planner.put_step("atomic_read_burst", fresh)
+        if fresh or not planner.step_ok("burst_read_case"):
+            planner.write_step("burst_read_case")
+        if control.lg_arbread_burst(DDC_50_D1_BURST+61, 4) == [0x50, 0x60, 0x82, 0x2f]:
+            control.has_burst_read = True
+
+    #
+    # DDC2AB (0x50) 0x75 sums up a range on the monitor. Same as the burst
+    # patches, the case goes in after the routine reads back. Then have it
+    # sum up its own code, unpatched it'd still answer 0x82 with whatever was
+    # in the reply buffer.
+    #
+    if not control.has_region_checksum:
+        planner.put_step("region_checksum", fresh)
+        if fresh or not planner.step_ok("region_checksum_case"):
+            planner.write_step("region_checksum_case")
+
+        addr, val = planner.steps["region_checksum"]["ranges"][0]
+        val = bytes.fromhex(val)
+        if control.region_checksum_request(addr, len(val)) == region_checksum_data(val):
+            control.has_region_checksum = True
+
+    #
+    # Everything else: the rest of the switch-table cases, VCP 0xD7
+    # setter/getter to just send raw split values and the PIP/PBP menu
+    # unlocks. Only what doesn't read back right gets written.
+    #
+    missing = planner.apply()
+
+    if missing == 0 and planner.checksums is None:
+        planner.record_checksums()
+
+    return missing
+
+# Hash of everything the patch plan reads back, as it is on the monitor right
+# now (gaps between patched ranges included)
+def patched_digest(control, reads=None):
+    if reads is None:
+        reads = [bytes(control.lg_arbread_data(addr, data_len, use_cache=False)) for addr, data_len in load_patch_planner(control).spans]
+    h = hashlib.sha256()
+    for data in reads:
+        h.update(data)
+    return h.hexdigest()
+
+def save_session(control, fpath=None):
+    if fpath is None:
+        fpath = session_path(control)
+    if not fpath:
+        return
+    planner = load_patch_planner(control)
+
+    session = {
+        "firmware": list(control.firmware),
+        "plan_digest": planner.plan["digest"],
+        # run_patches just read everything back, no need to do it again
+        "patched_digest": patched_digest(control, planner.last_read),
+        "has_burst_read": control.has_burst_read,
+        "has_burst_write": control.has_burst_write,
+        "has_region_checksum": control.has_region_checksum,
+        "checksums": planner.checksums,
+        "saved": time.time(),
+    }
+    try:
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath + ".tmp", "w") as f:
+            json.dump(session, f, indent=2, sort_keys=True)
+        os.replace(fpath + ".tmp", fpath)
+    except OSError as e:
+        print ("Couldn't save session", e)
+
+def load_session(control, fpath=None):
+    if fpath is None:
+        fpath = session_path(control)
+    if not fpath:
+        return None
+
+    try:
+        with open(fpath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# (model, scalar version) as the monitor reports it over 0xCA/0xC9, both
+# stock LG commands that are safe to send before we know what we're talking to
+def read_firmware(control):
+    scalar_fw_version = control.lg_special(0xc9,0)[0:0+3]
+    model_str = bytes(control.lg_special(0xca,0)[0:0+7])
+    return (model_str.decode("ascii", "replace"), bytes(scalar_fw_version).hex())
+
+#
+# If the monitor still has everything the last run put down (app restart,
+# nothing slept in between), there's nothing to check or patch. The patches
+# only live in RAM, so our own burst read answering, the sentinel and the
+# patched ranges all reading back like last time can't happen on a monitor
+# we haven't already checked the firmware of.
+#
+# Returns True if the session was picked back up.
+#
+def warm_start(control, fpath=None, firmware=None):
+    session = load_session(control, fpath)
+    if session is None:
+        return False
+
+    if tuple(session.get("firmware", [])) not in SUPPORTED_FIRMWARE or not session.get("has_burst_read"):
+        return False
+
+    # Nothing custom goes out until we know this is the monitor the session
+    # was saved against, 0xD6 means something else to stock firmware
+    if firmware is None:
+        firmware = read_firmware(control)
+    if firmware != tuple(session["firmware"]):
+        return False
+
+    control.firmware = firmware
+    planner = load_patch_planner(control)
+    if planner.plan["digest"] != session.get("plan_digest"):
+        control.firmware = None
+        return False
+
+    # A reset puts LG's own 0xD6 handler back, which won't hand us our code
+    if control.lg_arbread_burst(DDC_50_D1_BURST+61, 4) != [0x50, 0x60, 0x82, 0x2f]:
+        control.firmware = None
+        return False
+    control.has_burst_read = True
+
+    try:
+        ok = control.lg_arbread_u16_be(PATCH_SENTINEL_ADDR) == 0x55aa
+        if ok and session.get("has_region_checksum") and session.get("checksums"):
+            # A few sums on the monitor instead of reading it all back
+            control.has_region_checksum = True
+            planner.checksums = [tuple(c) for c in session["checksums"]]
+            ok = planner.checksums_ok()
+        elif ok:
+            ok = patched_digest(control) == session.get("patched_digest")
+    except DeviceTimeout:
+        # Cold start it is, that one copes with a slow exchange or two
+        ok = False
+
+    if not ok:
+        control.has_burst_read = False
+        control.has_region_checksum = False
+        planner.checksums = None
+        control.firmware = None
+        return False
+
+    control.has_burst_write = bool(session.get("has_burst_write"))
+    return True
+
+# Checks the firmware and gets the patches in, returns False if we can't go on
+def startup(control):
+    control.init_usb()
+
+    firmware = read_firmware(control)
+    if firmware not in SUPPORTED_FIRMWARE:
+        print("Please read the README and don't run random mempoke scripts on your monitor.")
+        print("Scalar version:", firmware[1])
+        print("Model:", firmware[0])
+        return False
+
+    if warm_start(control, firmware=firmware):
+        print (control.describe() + ": already patched, picking up where we left off.")
+        return True
+
+    control.firmware = firmware
+
+    # Reset just to make sure the monitor is in a clean state,
+    # unless we detect our atomic arbread working
+    try:
+        patched = control.lg_arbread_u16_be(PATCH_SENTINEL_ADDR) == 0x55aa
+    except DeviceTimeout:
+        patched = False
+    if not patched:
+        #control.lg_reset_monitor()
+        time.sleep(1)
+
+    # Sometimes writes get dropped...
+    # The CC commands do not return *anything* so there's no way to know
+    # until the arbread patch goes through. An exchange that times out
+    # just costs that pass, the next one picks up where it left off.
+    for i in range(0, 10):
+        try:
+            missing = run_patches(control)
+        except DeviceTimeout as e:
+            missing = None
+            print ("Arbread test failed...", e)
+
+        if missing == 0:
+            print ("Arbread test successful.")
+            save_session(control)
+            return True
+        elif missing is not None:
+            if i == 0:
+                # A fresh monitor has everything written on the first pass,
+                # only the ones after it tell whether it stuck
+                continue
+            print ("Arbread test failed...", missing, "patched ranges had to be rewritten")
+        if i == 9:
+            print ("Exiting.")
+            control.lg_reset_monitor()
+            return False
+        print ("Trying again...")
@@ -0,0 +1,131 @@
+from lg_monitor.control import (
+    LG_MONITOR_HDMI2, LG_MONITOR_USB_C, LG_SOUND_SUB, LG_SPLIT_FIX_AUDIO,
+    LG_SPLIT_NONE, LG_SPLIT_TOP_BOTTOM, MONITOR_INFO_STRUCT,
+)
+
+#
+# Scenes: the split, inputs and sound source a layout wants. Fields left out
+# stay however they are.
+#
+SCENES = {
+    "single": {"split": LG_SPLIT_NONE},
+    "top_bottom": {"split": LG_SPLIT_TOP_BOTTOM},
+    "splatoon": {"sound": LG_SOUND_SUB, "primary": LG_MONITOR_USB_C, "secondary": LG_MONITOR_HDMI2, "split": LG_SPLIT_TOP_BOTTOM},
+}
+
+# Scene fields living in MONITOR_INFO_STRUCT, in the order they get written.
+# They all fit in one burst read.
+SCENE_MEMORY_FIELDS = [
+    ("sound", MONITOR_INFO_STRUCT+0x2b5),
+    ("primary", MONITOR_INFO_STRUCT+0x2d0),
+    ("secondary", MONITOR_INFO_STRUCT+0x2d1),
+]
+SCENE_MEMORY_ADDR = MONITOR_INFO_STRUCT+0x2b5
+SCENE_MEMORY_LEN = 0x2d2 - 0x2b5
+
+def scene_memory_state(data):
+    return {name: data[addr-SCENE_MEMORY_ADDR] for name, addr in SCENE_MEMORY_FIELDS}
+
+# The named scene memory fields. With burst reads the whole span is one
+# exchange, without them it would be one per byte of it, so only the wanted
+# fields get read (each through the shadow cache if use_cache).
+def read_scene_memory(control, names=None, use_cache=True):
+    if names is None:
+        names = [name for name, addr in SCENE_MEMORY_FIELDS]
+    if control.has_burst_read:
+        state = scene_memory_state(control.lg_arbread_data(SCENE_MEMORY_ADDR, SCENE_MEMORY_LEN, use_cache))
+        return {name: state[name] for name in names}
+    return {name: control.lg_arbread_data(addr, 1, use_cache)[0] for name, addr in SCENE_MEMORY_FIELDS if name in names}
+
+# Current state of the scene fields, out of the shadow cache when it can be.
+# The split is a VCP read, so it's only looked up if asked for. `names` picks
+# the memory fields, all of them by default.
+def scene_state(control, with_split=True, use_cache=True, names=None):
+    state = read_scene_memory(control, names, use_cache)
+    if with_split:
+        state["split"] = control.lg_get_split(use_cache)
+    return state
+
+#
+# Only writes the fields that differ: the memory fields in one write batch,
+# then the split (which makes the monitor pick up the new inputs). A sound
+# change without a split change gets LG_SPLIT_FIX_AUDIO to take. Reading
+# back the written fields at the end checks they went in, the split set is
+# acked on its own.
+#
+# Returns True if the monitor ends up in the scene.
+#
+def apply_scene(control, scene):
+    target = SCENES[scene] if isinstance(scene, str) else scene
+
+    cur = scene_state(control, with_split="split" in target, names=[name for name in target if name != "split"])
+    changes = dict()
+    for name, val in target.items():
+        if cur[name] != val:
+            changes[name] = val
+    if not changes:
+        return True
+
+    with control.write_batch():
+        for name, addr in SCENE_MEMORY_FIELDS:
+            if name in changes:
+                control.my_arbwrite_u8(addr, changes[name])
+
+    ok = True
+    if "split" in changes:
+        ok = control.lg_set_split(changes["split"])
+    elif "sound" in changes:
+        ok = control.set_vcp(0xd7, LG_SPLIT_FIX_AUDIO) != -1
+        control.split_cache = None
+
+    written = [name for name, addr in SCENE_MEMORY_FIELDS if name in changes]
+    if written:
+        now = read_scene_memory(control, written, use_cache=False)
+        for name in written:
+            if now[name] != changes[name]:
+                ok = False
+
+    print (control.describe() + ":", "set" if ok else "failed to set", changes)
+    return ok
+
+# What applying a scene sets, for coalescing queued menu clicks
+def scene_targets(scene):
+    targets = set()
+    for name in SCENES[scene]:
+        if name == "split":
+            targets.add(("vcp", 0xd7))
+        else:
+            targets.add(("mem", dict(SCENE_MEMORY_FIELDS)[name]))
+    return frozenset(targets)
+
+#
+# Menu actions, these run on each monitor's worker
+#
+def do_single_pane(control):
+    return apply_scene(control, "single")
+
+def do_double_pane(control):
+    return apply_scene(control, "top_bottom")
+
+def do_swap_sound_sources(control):
+    swap_lut = [1,0]
+    cur = scene_state(control, with_split=False, names=["sound"])
+    return apply_scene(control, {"sound": swap_lut[cur["sound"] & 1]})
+
+def do_swap_splits(control):
+    swap_lut = [1,0]
+    cur = scene_state(control, with_split=False, names=["sound", "secondary"])
+    control.lg_set_cur_monitor_sound(swap_lut[cur["sound"] & 1])
+    control.lg_set_primary_input(cur["secondary"])
+
+def do_splatoon(control):
+    return apply_scene(control, "splatoon")
+
+MONITOR_INPUT_NAMES = ["HDMI1", "HDMI2", "DP", "USB-C"]
+
+def input_name(val):
+    if val is None:
+        return "?"
+    if val < len(MONITOR_INPUT_NAMES):
+        return MONITOR_INPUT_NAMES[val]
+    return hex(val)
@@ -0,0 +1,300 @@
+import asyncio
+import threading
+import time
+
+from lg_monitor.control import (
+    DDC_50_BURST_MAX_READ, DDC_50_BURST_MAX_WRITE, LG_MONITOR_CONTROL_PID,
+    LG_MONITOR_CONTROL_VID, LG_SPECIAL_TIMEOUT, PRIORITY_BACKGROUND, VCP_TIMEOUT,
+    DeviceWorker, LgUsbMonitorControl, enumerate_monitors,
+)
+from lg_monitor.patches import startup
+
+#
+# Several monitors at once, and the ways in that don't block on one: the
+# asyncio front and the memory watcher.
+#
+# MemoryWatcher poll intervals (in seconds). Groups that keep changing get
+# polled faster, quiet ones back off.
+WATCH_INTERVAL_MIN = 0.1
+WATCH_INTERVAL_MAX = 2.0
+WATCH_BACKOFF = 1.5
+
+#
+# One monitor: its connection plus the worker that owns it. Sessions share
+# nothing, so several monitors can be driven at once and a slow one only
+# holds up itself.
+#
+# hooks: HookRunner told about whatever heartbeats turn up, if any
+#
+class MonitorSession:
+
+    def __init__(self, control, hooks=None):
+        self.control = control
+        self.worker = DeviceWorker(control)
+        self.hooks = hooks
+        self.heartbeat_future = None
+        self.link_down = False
+
+    def name(self):
+        return self.control.describe()
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.worker.stop()
+
+    # Queues fn(control, *args, **kwargs) on this monitor's worker
+    def submit(self, fn, *args, **kwargs):
+        return self.worker.submit(fn, self.control, *args, **kwargs)
+
+    def schedule(self, priority, targets, fn, *args, **kwargs):
+        return self.worker.schedule(priority, targets, fn, self.control, *args, **kwargs)
+
+    # Runs on the worker once a heartbeat() is done
+    def heartbeat_done(self, future):
+        try:
+            events = future.result()
+        except Exception:
+            events = ["error"]
+
+        if self.link_down and "disconnected" not in events:
+            events += ["reconnected"]
+        self.link_down = "disconnected" in events
+
+        if events:
+            print (self.name() + ":", ", ".join(events))
+            if self.hooks is not None:
+                self.hooks.run(events)
+
+def open_monitor_sessions(enumerate_fn=None, backend=None, hooks=None):
+    sessions = []
+    for path, serial in enumerate_monitors(enumerate_fn):
+        session = MonitorSession(LgUsbMonitorControl(backend=backend, path=path, serial=serial, enumerate_fn=enumerate_fn), hooks)
+        session.start()
+        sessions += [session]
+    return sessions
+
+#
+# Every monitor gets its own worker, and they all start up at once. From
+# here on only the workers talk to the monitors. Returns the sessions that
+# made it.
+#
+def start_monitor_sessions(enumerate_fn=None, backend=None, hooks=None):
+    sessions = open_monitor_sessions(enumerate_fn, backend, hooks)
+    started = fan_out(sessions, startup)
+    for session, ok in zip(sessions, started):
+        if ok is not True:
+            print (session.name(), "didn't start, leaving it alone")
+            session.stop()
+    return [session for session, ok in zip(sessions, started) if ok is True]
+
+# Queues fn(control, ...) on every session, returns the futures in order
+def submit_all(sessions, fn, *args, **kwargs):
+    return [session.submit(fn, *args, **kwargs) for session in sessions]
+
+def schedule_all(sessions, priority, targets, fn, *args, **kwargs):
+    return [session.schedule(priority, targets, fn, *args, **kwargs) for session in sessions]
+
+#
+# Runs fn(control, ...) on every monitor at the same time and waits for all
+# of them, so it takes as long as the slowest one rather than the sum.
+# Returns each session's result, or the exception it raised, in order.
+#
+def fan_out(sessions, fn, *args, **kwargs):
+    results = []
+    for future in submit_all(sessions, fn, *args, **kwargs):
+        try:
+            results += [future.result()]
+        except Exception as e:
+            results += [e]
+    return results
+
+#
+# asyncio front for LgUsbMonitorControl, backed by a DeviceWorker so the UI,
+# the heartbeat and bulk memory tools can all await requests on the same
+# connection without blocking the event loop. The bridge doesn't tag its
+# reports, so only one DDC exchange is on the wire at a time; everything else
+# waits in the worker queue, and bulk reads are queued per chunk so small
+# requests get a turn in between.
+#
+class AsyncLgUsbMonitorControl:
+
+    def __init__(self, control=None, worker=None):
+        if worker is None:
+            if control is None:
+                control = LgUsbMonitorControl()
+            worker = DeviceWorker(control)
+            worker.start()
+            self.owns_worker = True
+        else:
+            control = worker.control
+            self.owns_worker = False
+        self.control = control
+        self.worker = worker
+
+    async def call(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.worker.submit(fn, *args, **kwargs))
+
+    def close(self):
+        if self.owns_worker:
+            self.worker.stop()
+
+    async def init_usb(self):
+        return await self.call(self.control.init_usb)
+
+    async def get_vcp(self, idx, timeout=VCP_TIMEOUT):
+        return await self.call(self.control.get_vcp, idx, timeout=timeout)
+
+    async def set_vcp(self, idx, val, timeout=VCP_TIMEOUT):
+        return await self.call(self.control.set_vcp, idx, val, timeout=timeout)
+
+    async def lg_special(self, idx, val, timeout=LG_SPECIAL_TIMEOUT):
+        return await self.call(self.control.lg_special, idx, val, timeout=timeout)
+
+    async def lg_special_u32(self, idx, val, timeout=LG_SPECIAL_TIMEOUT):
+        return await self.call(self.control.lg_special_u32, idx, val, timeout=timeout)
+
+    async def lg_special_u32_u8(self, idx, val, val2, timeout=LG_SPECIAL_TIMEOUT):
+        return await self.call(self.control.lg_special_u32_u8, idx, val, val2, timeout=timeout)
+
+    async def lg_arbread_u8(self, addr, timeout=LG_SPECIAL_TIMEOUT):
+        return await self.call(self.control.lg_arbread_u8, addr, timeout=timeout)
+
+    async def lg_arbread_data(self, addr, data_len, use_cache=True, timeout=LG_SPECIAL_TIMEOUT):
+        vals = []
+        for i in range(0, data_len, DDC_50_BURST_MAX_READ):
+            to_read = min(DDC_50_BURST_MAX_READ, data_len - i)
+            vals += await self.call(self.control.lg_arbread_data, addr+i, to_read, use_cache, timeout=timeout)
+        return vals
+
+    async def lg_arbwrite(self, addr, val, timeout=LG_SPECIAL_TIMEOUT):
+        return await self.call(self.control.lg_arbwrite, addr, val, timeout=timeout)
+
+    async def my_arbwrite(self, addr, val, timeout=LG_SPECIAL_TIMEOUT):
+        val = list(val)
+        for i in range(0, max(len(val), 1), DDC_50_BURST_MAX_WRITE):
+            await self.call(self.control.my_arbwrite, addr+i, val[i:i+DDC_50_BURST_MAX_WRITE], timeout=timeout)
+
+#
+# Polls a set of watched addresses on the device worker and calls back when
+# they change. Watched fields close enough to fit in one burst read share
+# it, and each of those groups gets polled more often while it's changing
+# and less when it isn't. Callbacks run on the watcher's own thread, as
+# callback(addr, old bytes, new bytes), so they're free to queue more
+# device work. The first read of a field calls back with old=None.
+#
+class MemoryWatcher:
+
+    def __init__(self, worker, interval_min=WATCH_INTERVAL_MIN, interval_max=WATCH_INTERVAL_MAX):
+        self.worker = worker
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.lock = threading.Lock()
+        self.watches = []
+        self.groups = []
+        # Last bytes each watch saw, keyed by its handle so two watches on
+        # the same field each get their own change
+        self.prev = dict()
+        self.next_id = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Returns a handle for unwatch()
+    def watch(self, addr, data_len, callback):
+        with self.lock:
+            handle = (addr, data_len, callback, self.next_id)
+            self.next_id += 1
+            self.watches += [handle]
+            self.prev[handle] = None
+            self.regroup()
+        return handle
+
+    def unwatch(self, handle):
+        with self.lock:
+            self.watches.remove(handle)
+            del self.prev[handle]
+            self.regroup()
+
+    # Call with self.lock held
+    def regroup(self):
+        groups = []
+        for handle in sorted(self.watches, key=lambda w: w[0]):
+            addr, data_len = handle[0], handle[1]
+            if groups and max(addr + data_len, groups[-1]["addr"] + groups[-1]["len"]) - groups[-1]["addr"] <= DDC_50_BURST_MAX_READ:
+                group = groups[-1]
+                group["len"] = max(addr + data_len, group["addr"] + group["len"]) - group["addr"]
+            else:
+                group = {"addr": addr, "len": data_len, "interval": self.interval_min, "due": 0.0, "watches": []}
+                groups += [group]
+            group["watches"] += [handle]
+        self.groups = groups
+
+    # Runs on the device worker, returns [(callback, addr, old, new)]
+    #
+    # Only the read happens outside the lock. A watch()/unwatch() in the
+    # meantime may have regrouped, so the results go to whichever watches
+    # are still there, and a group that was replaced is left alone (its
+    # replacement is due straight away anyway).
+    def poll(self):
+        events = []
+        now = time.monotonic()
+        with self.lock:
+            groups = [(g, g["addr"], g["len"], list(g["watches"])) for g in self.groups if g["due"] <= now]
+
+        for i, (group, group_addr, group_len, watches) in enumerate(groups):
+            if i:
+                self.worker.control.yield_point()
+            data = bytes(self.worker.control.lg_arbread_data(group_addr, group_len, use_cache=False))
+            changed = False
+            with self.lock:
+                for handle in watches:
+                    if handle not in self.prev:
+                        continue
+                    addr, data_len, callback = handle[0], handle[1], handle[2]
+                    new = data[addr-group_addr:addr-group_addr+data_len]
+                    old = self.prev[handle]
+                    self.prev[handle] = new
+                    if old != new:
+                        events += [(callback, addr, old, new)]
+                        changed = changed or old is not None
+
+                if changed:
+                    group["interval"] = max(self.interval_min, group["interval"] / 2)
+                else:
+                    group["interval"] = min(self.interval_max, group["interval"] * WATCH_BACKOFF)
+                group["due"] = time.monotonic() + group["interval"]
+        return events
+
+    # How long until the next group wants polling
+    def next_due(self):
+        with self.lock:
+            if not self.groups:
+                return self.interval_max
+            return max(0.0, min(g["due"] for g in self.groups) - time.monotonic())
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="lg_watch", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.next_due()):
+            try:
+                events = self.worker.schedule(PRIORITY_BACKGROUND, None, self.poll).result()
+            except Exception as e:
+                print ("Watch poll failed:", e)
+                self.stopped.wait(self.interval_max)
+                continue
+
+            for callback, addr, old, new in events:
+                try:
+                    callback(addr, old, new)
+                except Exception as e:
+                    print ("Watch callback for", hex(addr), "failed:", e)
@@ -0,0 +1,213 @@
+import argparse
+import gzip
+import json
+import mmap
+import struct
+import sys
+import time
+
+from lg_monitor import LgUsbMonitorControl, startup
+from lg_monitor.control import MONITOR_INFO_STRUCT, region_checksum_data
+
+#
+# Snapshots of monitor RAM, for working out what a struct field does:
+#
+#   python lg_snapshot.py capture before.snap
+#   (poke at the OSD)
+#   python lg_snapshot.py capture after.snap --base before.snap
+#   python lg_snapshot.py diff before.snap after.snap
+#
+# Snapshot files are a small header, a JSON blob, a table of ranges and then
+# the raw bytes of every range, so an uncompressed one can just be mmapped.
+# Anything ending in .gz is gzipped on the way out and in.
+#
+#   header: magic, version, range count, capture time, JSON length
+#   ranges: addr, len, file offset of the bytes
+#
+SNAPSHOT_MAGIC = b"LGSNAP\x00\x00"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sIIdI")
+SNAPSHOT_RANGE = struct.Struct("<IIQ")
+
+# What gets captured if no --range is given
+SNAPSHOT_DEFAULT_RANGES = [(MONITOR_INFO_STRUCT, 0x1000)]
+
+# Diffs compare this much at a time and only look at single bytes in blocks
+# that differ
+SNAPSHOT_DIFF_BLOCK = 0x1000
+
+# With --base, ranges get split in half until they either checksum the same
+# as before or are this small, then read
+SNAPSHOT_LEAF = 0x40
+
+class Snapshot:
+
+    def __init__(self, ranges=None, timestamp=None, meta=None):
+        # [(addr, bytes-like)], sorted
+        self.ranges = sorted(ranges or [], key=lambda r: r[0])
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.meta = meta or dict()
+        self.mapped = None
+
+    def save(self, fpath):
+        meta = json.dumps(self.meta, sort_keys=True).encode("utf-8")
+        offset = SNAPSHOT_HEADER.size + len(meta) + SNAPSHOT_RANGE.size * len(self.ranges)
+
+        table = b""
+        for addr, data in self.ranges:
+            table += SNAPSHOT_RANGE.pack(addr, len(data), offset)
+            offset += len(data)
+
+        opener = gzip.open if fpath.endswith(".gz") else open
+        with opener(fpath, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(self.ranges), self.timestamp, len(meta)))
+            f.write(meta)
+            f.write(table)
+            for addr, data in self.ranges:
+                f.write(data)
+
+    @staticmethod
+    def load(fpath):
+        if fpath.endswith(".gz"):
+            with gzip.open(fpath, "rb") as f:
+                buf = f.read()
+            mapped = None
+        else:
+            with open(fpath, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            buf = mapped
+
+        magic, version, count, timestamp, meta_len = SNAPSHOT_HEADER.unpack_from(buf, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(fpath + " isn't a snapshot (or is from a newer version)")
+
+        pos = SNAPSHOT_HEADER.size
+        meta = json.loads(bytes(buf[pos:pos+meta_len]).decode("utf-8"))
+        pos += meta_len
+
+        view = memoryview(buf)
+        ranges = []
+        for i in range(0, count):
+            addr, data_len, offset = SNAPSHOT_RANGE.unpack_from(buf, pos)
+            pos += SNAPSHOT_RANGE.size
+            ranges += [(addr, view[offset:offset+data_len])]
+
+        snap = Snapshot(ranges, timestamp, meta)
+        snap.mapped = mapped
+        return snap
+
+    # Returns the bytes at addr..addr+data_len if one range has all of them
+    def find(self, addr, data_len):
+        for start, data in self.ranges:
+            if addr >= start and addr + data_len <= start + len(data):
+                return data[addr-start:addr-start+data_len]
+        return None
+
+# Returns [(addr, old bytes, new bytes)] for every run of bytes that differs
+def diff_data(addr, old, new, block=SNAPSHOT_DIFF_BLOCK):
+    old = memoryview(old)
+    new = memoryview(new)
+    data_len = min(len(old), len(new))
+
+    runs = []
+    for i in range(0, data_len, block):
+        # Whole blocks compare as bytes, which is a memcmp
+        if old[i:i+block].tobytes() == new[i:i+block].tobytes():
+            continue
+        for j in range(i, min(i+block, data_len)):
+            if old[j] == new[j]:
+                continue
+            if runs and runs[-1][0] + len(runs[-1][1]) == addr+j:
+                runs[-1][1].append(old[j])
+                runs[-1][2].append(new[j])
+            else:
+                runs += [(addr+j, bytearray([old[j]]), bytearray([new[j]]))]
+    return runs
+
+def diff_snapshots(old, new):
+    runs = []
+    for addr, data in new.ranges:
+        prev = old.find(addr, len(data))
+        if prev is None:
+            print ("%08x+%x isn't in the old snapshot, skipping" % (addr, len(data)))
+            continue
+        runs += diff_data(addr, prev, data)
+    return runs
+
+# Fills out[addr-start...] with the monitor's bytes, only reading what
+# doesn't checksum the same as `prev`
+def capture_changed(device, addr, data_len, prev, out, start):
+    if region_checksum_data(prev) == device.region_checksum(addr, data_len):
+        out[addr-start:addr-start+data_len] = prev
+        return 0
+
+    if data_len <= SNAPSHOT_LEAF:
+        out[addr-start:addr-start+data_len] = bytes(device.lg_arbread_data(addr, data_len, use_cache=False))
+        return data_len
+
+    half = data_len // 2
+    read = capture_changed(device, addr, half, prev[:half], out, start)
+    read += capture_changed(device, addr+half, data_len-half, prev[half:], out, start)
+    return read
+
+def capture(device, ranges, base=None):
+    captured = []
+    for addr, data_len in ranges:
+        prev = base.find(addr, data_len) if base is not None else None
+        if prev is not None and device.has_region_checksum:
+            out = bytearray(data_len)
+            read = capture_changed(device, addr, data_len, prev, out, addr)
+            print ("%08x+%x: read %x bytes, the rest didn't change" % (addr, data_len, read))
+        else:
+            out = bytearray(device.lg_arbread_data(addr, data_len, use_cache=False))
+        captured += [(addr, out)]
+
+    meta = {"firmware": list(device.firmware) if device.firmware else None}
+    return Snapshot(captured, meta=meta)
+
+def parse_range(s):
+    addr, data_len = s.split(":")
+    return (int(addr, 0), int(data_len, 0))
+
+def print_diff(runs):
+    for addr, old, new in runs:
+        print ("%08x: %s -> %s" % (addr, bytes(old).hex(" "), bytes(new).hex(" ")))
+    print (len(runs), "runs,", sum(len(r[1]) for r in runs), "bytes differ")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot and diff LG monitor RAM")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("capture", help="read ranges off the monitor into a snapshot file")
+    p.add_argument("out", help="snapshot to write, gzipped if it ends in .gz")
+    p.add_argument("--range", dest="ranges", action="append", type=parse_range, help="ADDR:LEN, can be given more than once (default: MONITOR_INFO_STRUCT)")
+    p.add_argument("--base", help="earlier snapshot, only what changed since gets read")
+
+    p = sub.add_parser("diff", help="show what changed between two snapshots")
+    p.add_argument("old")
+    p.add_argument("new")
+
+    args = parser.parse_args()
+
+    if args.cmd == "diff":
+        print_diff(diff_snapshots(Snapshot.load(args.old), Snapshot.load(args.new)))
+        sys.exit(0)
+
+    base = Snapshot.load(args.base) if args.base else None
+    ranges = args.ranges
+    if not ranges and base is not None:
+        ranges = [(addr, len(data)) for addr, data in base.ranges]
+    elif not ranges:
+        ranges = SNAPSHOT_DEFAULT_RANGES
+
+    device = LgUsbMonitorControl()
+    if not startup(device):
+        sys.exit(1)
+
+    start = time.time()
+    snap = capture(device, ranges, base)
+    snap.save(args.out)
+    print ("Saved", args.out, "in %.1fs" % (time.time() - start))
+
+    if base is not None:
+        print_diff(diff_snapshots(base, snap))